@@ -0,0 +1,97 @@
+import math
+import threading
+import time
+from collections import deque
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, retry_after, in_flight, high_water):
+        super().__init__(f"Server is busy with {in_flight:.0f}s of audio in flight "
+                         f"(limit {high_water:.0f}s), retry in {retry_after}s.")
+        self.retry_after = retry_after
+
+
+class AdmissionController(object):
+    """
+    Admits synthesis work by its estimated cost in seconds of audio.
+
+    Every request reserves its estimated audio seconds until it is released. Once
+    the reserved total would pass ``high_water`` new requests are rejected with
+    ``AdmissionRejected``, whose ``retry_after`` is the time the server needs to
+    drain the excess at the rate it recently completed work. A request is always
+    admitted when nothing else is in flight, so an oversized request still runs
+    on an idle server. ``high_water`` <= 0 disables rejection but still tracks
+    the in-flight work.
+    """
+
+    def __init__(self, high_water=0., chars_per_second=14., window=30., max_retry_after=60):
+        self.high_water = high_water
+        self.chars_per_second = chars_per_second
+        self.window = window
+        self.max_retry_after = max_retry_after
+        self.in_flight = 0.
+        self.requests = 0
+        self.admitted = 0
+        self.rejected = 0
+        self._completed = deque()
+        self._lock = threading.Lock()
+
+    def estimate(self, text, speed=1.0):
+        """Estimated seconds of audio synthesized from `text` at `speed`."""
+        return len(text) / self.chars_per_second / max(speed, 0.1)
+
+    def _drain_rate(self, now):
+        while self._completed and self._completed[0][0] < now - self.window:
+            self._completed.popleft()
+        if not self._completed:
+            return None
+        span = max(now - self._completed[0][0], 1.)
+        return sum(cost for _, cost in self._completed) / span
+
+    def acquire(self, cost):
+        now = time.monotonic()
+        with self._lock:
+            if self.high_water > 0 and self.requests and self.in_flight + cost > self.high_water:
+                self.rejected += 1
+                rate = self._drain_rate(now) or 1.
+                retry_after = math.ceil((self.in_flight + cost - self.high_water) / rate)
+                raise AdmissionRejected(min(max(retry_after, 1), self.max_retry_after),
+                                        self.in_flight, self.high_water)
+            self.in_flight += cost
+            self.requests += 1
+            self.admitted += 1
+        return cost
+
+    def release(self, cost):
+        now = time.monotonic()
+        with self._lock:
+            self.in_flight = max(self.in_flight - cost, 0.)
+            self.requests -= 1
+            self._completed.append((now, cost))
+
+    def admit(self, cost):
+        return _Admission(self, cost)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'in_flight_seconds': self.in_flight,
+                'in_flight_requests': self.requests,
+                'high_water_seconds': self.high_water,
+                'drain_rate': self._drain_rate(time.monotonic()),
+                'admitted': self.admitted,
+                'rejected': self.rejected,
+            }
+
+
+class _Admission(object):
+    def __init__(self, controller, cost):
+        self.controller = controller
+        self.cost = cost
+
+    def __enter__(self):
+        self.controller.acquire(self.cost)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.controller.release(self.cost)
@@ -55,11 +55,14 @@ class BaseSpeakerTTS(OpenVoiceBaseClass):
 
     @staticmethod
     def audio_numpy_concat(segment_data_list, sr, speed=1.):
-        audio_segments = []
-        for segment_data in segment_data_list:
-            audio_segments += segment_data.reshape(-1).tolist()
-            audio_segments += [0] * int((sr * 0.05)/speed)
-        audio_segments = np.array(audio_segments).astype(np.float32)
+        # Segments separated by 50 ms of silence, written into one preallocated array
+        gap = int((sr * 0.05) / speed)
+        segments = [np.asarray(segment_data).reshape(-1) for segment_data in segment_data_list]
+        audio_segments = np.zeros(sum(segment.size + gap for segment in segments), dtype=np.float32)
+        offset = 0
+        for segment in segments:
+            audio_segments[offset:offset + segment.size] = segment
+            offset += segment.size + gap
         return audio_segments
 
     @staticmethod
@@ -138,65 +141,235 @@ class ToneColorConverter(OpenVoiceBaseClass):
 
         return gs
 
-    def convert(self, audio_src_path, src_se, tgt_se, output_path=None, tau=0.3, message="default"):
+    def spectrogram(self, audio):
         hps = self.hps
-        # load audio
-        audio, sample_rate = librosa.load(audio_src_path, sr=hps.data.sampling_rate)
-        audio = torch.tensor(audio).float()
-        
         with torch.no_grad():
-            y = torch.FloatTensor(audio).to(self.device)
+            if isinstance(audio, torch.Tensor):
+                y = audio.to(self.device, torch.float32)
+            else:
+                # Shares the memory of a float32 array instead of copying it
+                y = torch.from_numpy(np.ascontiguousarray(audio, dtype=np.float32)).to(self.device)
             y = y.unsqueeze(0)
             spec = spectrogram_torch(y, hps.data.filter_length,
                                     hps.data.sampling_rate, hps.data.hop_length, hps.data.win_length,
                                     center=False).to(self.device)
-            spec_lengths = torch.LongTensor([spec.size(-1)]).to(self.device)
-            audio = self.model.voice_conversion(spec, spec_lengths, sid_src=src_se, sid_tgt=tgt_se, tau=tau)[0][
-                        0, 0].data.cpu().float().numpy()
-            audio = self.add_watermark(audio, message)
-            if output_path is None:
+        return spec
+
+    def convert_batch(self, specs, src_ses, tgt_ses, tau=0.3):
+        """
+        Run voice conversion on several spectrograms as one batch.
+
+        The spectrograms are zero-padded to the longest one and masked with their own
+        lengths through the posterior encoder and the flow, as in ``voice_conversion``.
+        The decoder has no mask, so padding would leak into the end of the shorter
+        items: it only batches spectrograms of the same length. The returned list holds
+        one float32 waveform per input, trimmed to size.
+        """
+        model = self.model
+        hop_length = self.hps.data.hop_length
+        lengths = [spec.size(-1) for spec in specs]
+        with torch.no_grad():
+            spec = specs[0].new_zeros(len(specs), specs[0].size(1), max(lengths))
+            for i, item in enumerate(specs):
+                spec[i, :, :lengths[i]] = item[0]
+            spec_lengths = torch.LongTensor(lengths).to(self.device)
+            g_src = torch.cat([se.to(self.device) for se in src_ses])
+            g_tgt = torch.cat([se.to(self.device) for se in tgt_ses])
+            z, _, _, y_mask = model.enc_q(spec, spec_lengths, g=g_src if not model.zero_g else torch.zeros_like(g_src),
+                                          tau=tau)
+            z_p = model.flow(z, y_mask, g=g_src)
+            z_hat = model.flow(z_p, y_mask, g=g_tgt, reverse=True) * y_mask
+            g_dec = g_tgt if not model.zero_g else torch.zeros_like(g_tgt)
+
+            audios = [None] * len(specs)
+            by_length = {}
+            for i, length in enumerate(lengths):
+                by_length.setdefault(length, []).append(i)
+            for length, items in by_length.items():
+                index = torch.tensor(items, device=self.device)
+                audio = model.dec(z_hat[index, :, :length], g=g_dec[index])[:, 0].data.cpu().float().numpy()
+                for i, item_audio in zip(items, audio):
+                    audios[i] = item_audio[:length * hop_length].copy()
+        return audios
+
+    def load_audio(self, audio, sampling_rate=None):
+        """
+        Return ``audio`` as a mono waveform at the converter's sampling rate.
+
+        ``audio`` is a path or file object, decoded with librosa, or a float
+        waveform (array or tensor) sampled at ``sampling_rate``, which is only
+        resampled when that rate differs from the converter's.
+        """
+        target_rate = self.hps.data.sampling_rate
+        if isinstance(audio, (np.ndarray, torch.Tensor)):
+            if sampling_rate is None or sampling_rate == target_rate:
                 return audio
-            else:
-                soundfile.write(output_path, audio, hps.data.sampling_rate)
+            if isinstance(audio, torch.Tensor):
+                audio = audio.detach().cpu().numpy()
+            return librosa.resample(np.asarray(audio, dtype=np.float32), orig_sr=sampling_rate, target_sr=target_rate)
+        audio, _ = librosa.load(audio, sr=target_rate)
+        return audio
+
+    def convert(self, audio_src_path, src_se, tgt_se, output_path=None, tau=0.3, message="default", batcher=None,
+                sampling_rate=None):
+        hps = self.hps
+        # load audio, `audio_src_path` may also be a waveform sampled at `sampling_rate`
+        audio = self.load_audio(audio_src_path, sampling_rate)
+        
+        spec = self.spectrogram(audio)
+        if batcher is not None:
+            # Let the batcher merge this request with others arriving at the same time
+            audio = batcher.convert(spec, src_se, tgt_se, tau=tau)
+        else:
+            audio = self.convert_batch([spec], [src_se], [tgt_se], tau=tau)[0]
+        if message is not None:
+            audio = self.add_watermark(audio, message)
+        if output_path is None:
+            return audio
+        else:
+            soundfile.write(output_path, audio, hps.data.sampling_rate)
     
+    @staticmethod
+    def watermark_chunks(length, K=16000, coeff=2):
+        """Number of K-sample watermark chunks, one every coeff * K samples, that fit in `length` samples."""
+        return (length // K - 1) // coeff + 1 if length >= K else 0
+
+    @staticmethod
+    def watermark_frames(audio, n_chunks, K=16000, coeff=2):
+        """
+        The first `n_chunks` watermark chunks of `audio` as an (n_chunks, K) tensor.
+
+        This is a strided view, not a copy: writing to it writes to `audio`.
+        """
+        signal = audio if isinstance(audio, torch.Tensor) else torch.from_numpy(audio)
+        return signal.as_strided((n_chunks, K), (coeff * K * signal.stride(0), signal.stride(0)))
+
     def add_watermark(self, audio, message):
         if self.watermark_model is None:
             return audio
-        device = self.device
         bits = utils.string_to_bits(message).reshape(-1)
         n_repeat = len(bits) // 32
 
-        K = 16000
-        coeff = 2
-        for n in range(n_repeat):
-            trunck = audio[(coeff * n) * K: (coeff * n + 1) * K]
-            if len(trunck) != K:
-                print('Audio too short, fail to add watermark')
-                break
-            message_npy = bits[n * 32: (n + 1) * 32]
-            
-            with torch.no_grad():
-                signal = torch.FloatTensor(trunck).to(device)[None]
-                message_tensor = torch.FloatTensor(message_npy).to(device)[None]
-                signal_wmd_tensor = self.watermark_model.encode(signal, message_tensor)
-                signal_wmd_npy = signal_wmd_tensor.detach().cpu().squeeze()
-            audio[(coeff * n) * K: (coeff * n + 1) * K] = signal_wmd_npy
+        if not isinstance(audio, torch.Tensor):
+            audio = np.ascontiguousarray(audio)
+        n_chunks = min(self.watermark_chunks(len(audio)), n_repeat)
+        if n_chunks < n_repeat:
+            print('Audio too short, fail to add watermark')
+        if n_chunks == 0:
+            return audio
+
+        # Every 32-bit block of the message goes into its own chunk
+        self.embed_watermark(self.watermark_frames(audio, n_chunks), bits[:n_chunks * 32].reshape(n_chunks, 32))
         return audio
 
+    def embed_watermark(self, frames, bits):
+        """
+        Embed the 32-bit blocks of `bits` (n, 32) into the rows of `frames` (n, K), in place.
+
+        All blocks are encoded in a single batched call. Batched kernels may round differently
+        from one block at a time, so WatermarkStream, which embeds block by block, matches
+        add_watermark up to that float rounding; the embedded bits are the same.
+        """
+        device = self.device
+        with torch.no_grad():
+            signal = frames.to(device, torch.float32)
+            message_tensor = torch.from_numpy(bits).to(device, torch.float32)
+            signal_wmd_tensor = self.watermark_model.encode(signal, message_tensor)
+            frames.copy_(signal_wmd_tensor.detach())
+
+    def watermark_stream(self, message):
+        """An incremental ``add_watermark`` of `message` for audio produced in chunks, see WatermarkStream."""
+        return WatermarkStream(self, message)
+
     def detect_watermark(self, audio, n_repeat):
-        bits = []
-        K = 16000
-        coeff = 2
-        for n in range(n_repeat):
-            trunck = audio[(coeff * n) * K: (coeff * n + 1) * K]
-            if len(trunck) != K:
-                print('Audio too short, fail to detect watermark')
-                return 'Fail'
-            with torch.no_grad():
-                signal = torch.FloatTensor(trunck).to(self.device).unsqueeze(0)
-                message_decoded_npy = (self.watermark_model.decode(signal) >= 0.5).int().detach().cpu().numpy().squeeze()
-            bits.append(message_decoded_npy)
-        bits = np.stack(bits).reshape(-1, 8)
-        message = utils.bits_to_string(bits)
+        if self.watermark_chunks(len(audio)) < n_repeat:
+            print('Audio too short, fail to detect watermark')
+            return 'Fail'
+        if not isinstance(audio, torch.Tensor):
+            audio = np.ascontiguousarray(audio)
+        with torch.no_grad():
+            signal = self.watermark_frames(audio, n_repeat).to(self.device, torch.float32)
+            bits = (self.watermark_model.decode(signal) >= 0.5).int().detach().cpu().numpy()
+        message = utils.bits_to_string(bits.reshape(-1, 8))
         return message
+
+    def detect_watermarks(self, audios, n_repeat, batch_size=64):
+        """
+        Detect the watermark of many audios at once.
+
+        ``audios`` holds paths, file objects or waveforms at the converter's sampling
+        rate. The chunks of all of them are decoded together, ``batch_size`` chunks
+        per forward pass. Returns one message per audio, 'Fail' for audios too short
+        to hold ``n_repeat`` chunks.
+        """
+        results = []
+        frames = []
+        for audio in audios:
+            audio = self.load_audio(audio)
+            if not isinstance(audio, torch.Tensor):
+                audio = np.ascontiguousarray(audio)
+            if self.watermark_chunks(len(audio)) < n_repeat:
+                results.append('Fail')
+                continue
+            results.append(None)
+            frames.append(self.watermark_frames(audio, n_repeat).to(torch.float32))
+        if not frames:
+            return results
+
+        with torch.no_grad():
+            signal = torch.cat(frames)
+            bits = torch.cat([(self.watermark_model.decode(signal[start:start + batch_size].to(self.device)) >= 0.5)
+                              .int().cpu() for start in range(0, len(signal), batch_size)]).numpy()
+        messages = iter(bits.reshape(len(frames), -1, 8))
+        return [utils.bits_to_string(next(messages)) if result is None else result for result in results]
     
+
+
+class WatermarkStream(object):
+    """
+    Incremental ``ToneColorConverter.add_watermark`` for audio produced in chunks.
+
+    The output of ``write`` and ``close``, put together, is what ``add_watermark``
+    makes of the whole input, up to the float rounding of the watermark model:
+    blocks are embedded one at a time here and batched there. Each watermark
+    block is embedded as soon as its last sample arrives. Samples are only held back while they belong to a
+    block that is not complete yet, so at most K samples are buffered.
+    """
+
+    def __init__(self, converter, message, K=16000, coeff=2):
+        self.converter = converter
+        self.bits = utils.string_to_bits(message).reshape(-1)
+        self.n_repeat = len(self.bits) // 32 if converter.watermark_model is not None else 0
+        self.K = K
+        self.coeff = coeff
+        self.block = 0
+        # Position of the first held back sample in the whole audio
+        self.offset = 0
+        self._carry = np.zeros(0, dtype=np.float32)
+
+    def write(self, audio):
+        """Add the next chunk of audio and return the samples that are final."""
+        carry = np.concatenate([self._carry, np.asarray(audio, dtype=np.float32).reshape(-1)])
+        K = self.K
+        while self.block < self.n_repeat:
+            start = self.coeff * self.block * K - self.offset
+            if len(carry) < start + K:
+                break
+            self.converter.embed_watermark(torch.from_numpy(carry[start:start + K])[None],
+                                           self.bits[self.block * 32:(self.block + 1) * 32].reshape(1, 32))
+            self.block += 1
+        if self.block < self.n_repeat:
+            ready = min(self.coeff * self.block * K - self.offset, len(carry))
+        else:
+            ready = len(carry)
+        self.offset += ready
+        self._carry = carry[ready:]
+        return carry[:ready]
+
+    def close(self):
+        """Return the samples still held back, which the audio ended before they could be watermarked."""
+        if self.block < self.n_repeat:
+            print('Audio too short, fail to add watermark')
+        carry, self._carry = self._carry, np.zeros(0, dtype=np.float32)
+        self.offset += len(carry)
+        return carry
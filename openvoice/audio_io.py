@@ -0,0 +1,203 @@
+import io
+import struct
+
+import librosa
+import numpy as np
+import soundfile
+
+# Output formats: name -> (media type, soundfile container, soundfile subtype)
+AUDIO_FORMATS = {
+    'wav': ('audio/wav', 'WAV', 'PCM_16'),
+    'flac': ('audio/flac', 'FLAC', 'PCM_16'),
+    'opus': ('audio/ogg', 'OGG', 'OPUS'),
+    'mp3': ('audio/mpeg', 'MP3', 'MPEG_LAYER_III'),
+}
+# Extra encoder settings. Constant bitrate MP3 stays decodable without the Xing
+# header that libsndfile only writes when the file is closed, i.e. when streamed.
+ENCODER_OPTIONS = {
+    'mp3': {'bitrate_mode': 'CONSTANT', 'compression_level': 0.5},
+}
+# Formats the chunked endpoints can produce; 'pcm' is raw 16-bit little-endian PCM
+STREAM_FORMATS = ('pcm',) + tuple(AUDIO_FORMATS)
+MEDIA_TYPES = {
+    'audio/wav': 'wav', 'audio/wave': 'wav', 'audio/x-wav': 'wav',
+    'audio/flac': 'flac', 'audio/x-flac': 'flac',
+    'audio/ogg': 'opus', 'audio/opus': 'opus',
+    'audio/mpeg': 'mp3', 'audio/mp3': 'mp3',
+}
+OPUS_SAMPLING_RATES = (8000, 12000, 16000, 24000, 48000)
+
+
+def negotiate_format(format=None, accept=None, allowed=tuple(AUDIO_FORMATS), default='wav'):
+    """
+    Pick the output format from an explicit `format` name or an HTTP Accept header.
+
+    An explicit format that is not allowed raises ValueError. Accept headers are
+    matched by quality; anything unrecognised falls back to `default`.
+    """
+    if format:
+        format = format.lower()
+        if format not in allowed:
+            raise ValueError(f"Invalid format. Allowed formats are: {', '.join(allowed)}")
+        return format
+    ranges = []
+    for i, item in enumerate((accept or '').split(',')):
+        media_type, *params = [part.strip() for part in item.split(';')]
+        quality = 1.
+        for param in params:
+            if param.startswith('q='):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    quality = 0.
+        if media_type and quality > 0:
+            ranges.append((-quality, i, media_type.lower()))
+    for _, _, media_type in sorted(ranges):
+        if media_type in ('*/*', 'audio/*'):
+            return default
+        if MEDIA_TYPES.get(media_type) in allowed:
+            return MEDIA_TYPES[media_type]
+    return default
+
+
+def format_media_type(format):
+    if format == 'pcm':
+        return 'application/octet-stream'
+    return AUDIO_FORMATS[format][0]
+
+
+def encoding_rate(format, sampling_rate):
+    """Opus only encodes a few sample rates, use the next one up."""
+    if format == 'opus' and sampling_rate not in OPUS_SAMPLING_RATES:
+        return next((rate for rate in OPUS_SAMPLING_RATES if rate >= sampling_rate), OPUS_SAMPLING_RATES[-1])
+    return sampling_rate
+
+
+def resample(audio, sampling_rate, target_rate):
+    if sampling_rate == target_rate:
+        return audio
+    return librosa.resample(audio, orig_sr=sampling_rate, target_sr=target_rate)
+
+
+def encode_audio(audio, sampling_rate, format='wav'):
+    """Encode a float waveform in one of AUDIO_FORMATS without touching the filesystem."""
+    _, container, subtype = AUDIO_FORMATS[format]
+    rate = encoding_rate(format, sampling_rate)
+    buffer = io.BytesIO()
+    soundfile.write(buffer, resample(audio, sampling_rate, rate), rate, format=container, subtype=subtype,
+                    **ENCODER_OPTIONS.get(format, {}))
+    return buffer.getvalue()
+
+
+def pcm16(audio):
+    """Convert a float waveform to little-endian 16-bit PCM bytes."""
+    return (np.clip(audio, -1.0, 1.0) * 32767).astype('<i2').tobytes()
+
+
+def wav_stream_header(sampling_rate, channels=1, sample_width=2):
+    """
+    WAV header for a PCM stream whose length is not known yet.
+
+    The RIFF and data chunk sizes are set to 0xFFFFFFFF, which players treat as
+    "read until the end of the stream".
+    """
+    return struct.pack('<4sI4s4sIHHIIHH4sI',
+                       b'RIFF', 0xFFFFFFFF, b'WAVE',
+                       b'fmt ', 16, 1, channels, sampling_rate,
+                       sampling_rate * channels * sample_width, channels * sample_width, sample_width * 8,
+                       b'data', 0xFFFFFFFF)
+
+
+def probe_duration(data):
+    """Duration in seconds of an encoded audio file, estimated from its size when libsndfile cannot read it."""
+    try:
+        return soundfile.info(io.BytesIO(data)).duration
+    except Exception:
+        # Assume a 128 kbit/s compressed stream
+        return len(data) / 16000
+
+
+class _StreamSink(object):
+    """
+    Write-only file object for libsndfile that hands out bytes as soon as they are written.
+
+    Bytes that have been taken cannot be rewritten, so the header fields encoders
+    patch on close (FLAC total length and checksum) keep their "unknown" values,
+    which is how these formats are normally streamed.
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._base = 0
+        self._position = 0
+
+    def write(self, data):
+        offset = self._position - self._base
+        if offset >= 0:
+            self._buffer[offset:offset + len(data)] = data
+        self._position += len(data)
+        return len(data)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self._position = offset
+        elif whence == io.SEEK_CUR:
+            self._position += offset
+        else:
+            self._position = self._base + len(self._buffer) + offset
+        return self._position
+
+    def tell(self):
+        return self._position
+
+    def read(self, size=-1):
+        return b''
+
+    def take(self):
+        data = bytes(self._buffer)
+        self._base += len(data)
+        self._buffer = bytearray()
+        return data
+
+
+class AudioStreamEncoder(object):
+    """
+    Encode a waveform that is produced chunk by chunk, e.g. sentence by sentence.
+
+    ``start`` returns the container header, ``write`` the encoded bytes of each
+    chunk that are ready to be sent and ``close`` whatever the encoder still held.
+    Any of them may be empty.
+    """
+
+    def __init__(self, format, sampling_rate):
+        self.format = format
+        self.sampling_rate = sampling_rate
+        self.rate = encoding_rate(format, sampling_rate)
+        self.media_type = format_media_type(format)
+        self._sink = None
+        self._file = None
+        if format in AUDIO_FORMATS and format != 'wav':
+            _, container, subtype = AUDIO_FORMATS[format]
+            self._sink = _StreamSink()
+            self._file = soundfile.SoundFile(self._sink, 'w', self.rate, 1, format=container, subtype=subtype,
+                                             **ENCODER_OPTIONS.get(format, {}))
+
+    def start(self):
+        if self.format == 'wav':
+            return wav_stream_header(self.sampling_rate)
+        if self._file is None:
+            return b''
+        return self._sink.take()
+
+    def write(self, audio):
+        if self._file is None:
+            return pcm16(audio)
+        self._file.write(resample(audio, self.sampling_rate, self.rate))
+        return self._sink.take()
+
+    def close(self):
+        if self._file is None:
+            return b''
+        self._file.close()
+        return self._sink.take()
+
@@ -0,0 +1,76 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import nullcontext
+
+
+class ConversionBatcher(object):
+    """
+    Micro-batches ``ToneColorConverter`` voice conversion across threads.
+
+    Callers block in ``convert`` while a dispatcher thread collects the requests
+    that arrive within ``window`` seconds of the first one (up to
+    ``max_batch_size``), runs them through ``convert_batch`` in a single forward
+    pass and hands each caller its own waveform back. With a ``window`` of 0 a
+    batch only takes the requests already waiting, and never waits for more.
+    """
+
+    def __init__(self, converter, max_batch_size=8, window=0.005, lock=None):
+        self.converter = converter
+        self.max_batch_size = max_batch_size
+        self.window = window
+        self.lock = lock
+        self.batches = 0
+        self.items = 0
+        self._start()
+        # The dispatcher thread does not survive fork(), pre-forked server processes need their own
+        os.register_at_fork(after_in_child=self._start)
+
+    def _start(self):
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._loop, name='conversion-batcher', daemon=True)
+        self._thread.start()
+
+    def convert(self, spec, src_se, tgt_se, tau=0.3):
+        future = Future()
+        self._queue.put((spec, src_se, tgt_se, tau, future))
+        return future.result()
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            try:
+                # Past the deadline, still take what is already waiting
+                batch.append(self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self, batch):
+        specs, src_ses, tgt_ses, taus, futures = zip(*batch)
+        try:
+            with self.lock or nullcontext():
+                audios = self.converter.convert_batch(list(specs), list(src_ses), list(tgt_ses), tau=taus[0])
+        except Exception as e:
+            for future in futures:
+                future.set_exception(e)
+            return
+        self.batches += 1
+        self.items += len(batch)
+        for future, audio in zip(futures, audios):
+            future.set_result(audio)
+
+    def _loop(self):
+        while True:
+            batch = self._collect()
+            # tau scales the posterior noise for the whole forward pass, so only
+            # requests sharing a tau can go through together
+            by_tau = {}
+            for item in batch:
+                by_tau.setdefault(item[3], []).append(item)
+            for items in by_tau.values():
+                self._run(items)
@@ -0,0 +1,116 @@
+import os
+import time
+import asyncio
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+from openvoice import metrics
+
+
+class InferenceQueueFull(Exception):
+    pass
+
+
+class InferencePool(object):
+    """
+    Runs blocking model inference on a fixed number of worker threads so the
+    asyncio event loop stays free to accept requests.
+
+    At most ``max_workers`` jobs run at once and at most ``max_queue`` more may
+    wait for a worker; anything beyond that raises ``InferenceQueueFull``, or
+    waits for room with ``submit_when_room``.
+    Models that must not be entered from several threads at once are guarded
+    with ``model_lock(name)``.
+    """
+
+    def __init__(self, max_workers=1, max_queue=16):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+        self._start()
+        # Worker threads do not survive fork(), pre-forked server processes need their own
+        os.register_at_fork(after_in_child=self._start)
+
+    def _start(self):
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='inference')
+        self._state_lock = threading.Lock()
+        # Notified whenever a job gives its slot back
+        self._room = threading.Condition(self._state_lock)
+        self._pending = 0
+        self._running = 0
+
+    def model_lock(self, name):
+        with self._locks_lock:
+            lock = self._locks.get(name)
+            if lock is None:
+                lock = self._locks[name] = threading.RLock()
+            return lock
+
+    @property
+    def queued(self):
+        return self._pending - self._running
+
+    @property
+    def running(self):
+        return self._running
+
+    def _call(self, submitted, fn, args, kwargs):
+        metrics.observe_stage('queue', time.perf_counter() - submitted)
+        with self._state_lock:
+            self._running += 1
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self._state_lock:
+                self._running -= 1
+                self._release()
+
+    def _full(self):
+        return self._pending >= self.max_workers + self.max_queue
+
+    def _release(self):
+        """Give a slot back; called with the state lock held."""
+        self._pending -= 1
+        self._room.notify()
+
+    def submit(self, fn, *args, **kwargs):
+        """Submit ``fn`` to the pool and return a ``concurrent.futures.Future``."""
+        with self._state_lock:
+            if self._full():
+                raise InferenceQueueFull(f'inference queue is full ({self.max_queue} waiting)')
+            self._pending += 1
+        return self._enqueue(fn, args, kwargs)
+
+    def submit_when_room(self, fn, *args, **kwargs):
+        """Like ``submit``, but blocks the calling thread until the queue has room instead of raising."""
+        with self._room:
+            self._room.wait_for(lambda: not self._full())
+            self._pending += 1
+        return self._enqueue(fn, args, kwargs)
+
+    def _enqueue(self, fn, args, kwargs):
+        try:
+            # Run in a copy of the caller's context so per-request stage timings reach the worker
+            context = contextvars.copy_context()
+            future = self._executor.submit(context.run, self._call, time.perf_counter(), fn, args, kwargs)
+        except BaseException:
+            with self._state_lock:
+                self._release()
+            raise
+        # A job cancelled while it waits never reaches _call, give its slot back here
+        future.add_done_callback(self._release_cancelled)
+        return future
+
+    def _release_cancelled(self, future):
+        if future.cancelled():
+            with self._state_lock:
+                self._release()
+
+    async def run(self, fn, *args, **kwargs):
+        """Run ``fn`` on a worker thread and await its result."""
+        return await asyncio.wrap_future(self.submit(fn, *args, **kwargs))
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
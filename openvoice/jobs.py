@@ -0,0 +1,275 @@
+import json
+import os
+import queue
+import shutil
+import logging
+import tempfile
+import threading
+import time
+import uuid
+import zipfile
+
+logger = logging.getLogger(__name__)
+
+
+class Job(object):
+    """
+    A batch synthesis job and its results on disk.
+
+    ``<root>/<id>/job.json`` holds the items and timestamps. Each item leaves
+    ``<index>.<format>`` when it succeeds or ``<index>.error`` when it fails, so
+    progress can be read back from any process sharing the directory.
+    """
+
+    def __init__(self, root, job_id, items, format, created, started=None, finished=None):
+        self.id = job_id
+        self.path = os.path.join(root, job_id)
+        self.items = items
+        self.format = format
+        self.created = created
+        self.started = started
+        self.finished = finished
+        self.succeeded = 0
+        self.failed = 0
+        self.audio_seconds = 0.
+        self.cancelled = False
+
+    @classmethod
+    def load(cls, root, job_id):
+        with open(os.path.join(root, job_id, 'job.json')) as f:
+            data = json.load(f)
+        job = cls(root, job_id, data['items'], data['format'], data['created'], data.get('started'),
+                  data.get('finished'))
+        job.audio_seconds = data.get('audio_seconds', 0.)
+        job.cancelled = os.path.exists(os.path.join(job.path, 'cancelled'))
+        for name in os.listdir(job.path):
+            if name.endswith('.error'):
+                job.failed += 1
+            elif name.endswith('.' + job.format):
+                job.succeeded += 1
+        return job
+
+    def save(self):
+        data = {'items': self.items, 'format': self.format, 'created': self.created, 'started': self.started,
+                'finished': self.finished, 'audio_seconds': self.audio_seconds}
+        # Unique, as a worker and a cancelling request may save the same job at once
+        fd, temp_path = tempfile.mkstemp(dir=self.path, prefix='job.json.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(data, f)
+            os.replace(temp_path, os.path.join(self.path, 'job.json'))
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def result_path(self, index):
+        return os.path.join(self.path, f'{index:05d}.{self.format}')
+
+    def error_path(self, index):
+        return os.path.join(self.path, f'{index:05d}.error')
+
+    def error(self, index):
+        try:
+            with open(self.error_path(index)) as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    @property
+    def status(self):
+        if self.cancelled:
+            return 'cancelled'
+        if self.finished is not None:
+            return 'done'
+        return 'running' if self.started is not None else 'queued'
+
+    def summary(self):
+        elapsed = None
+        if self.started is not None:
+            elapsed = (self.finished or time.time()) - self.started
+        return {
+            'job_id': self.id,
+            'status': self.status,
+            'format': self.format,
+            'total': len(self.items),
+            'succeeded': self.succeeded,
+            'failed': self.failed,
+            'progress': (self.succeeded + self.failed) / len(self.items) if self.items else 1.,
+            'audio_seconds': self.audio_seconds,
+            'created': self.created,
+            'started': self.started,
+            'finished': self.finished,
+            'elapsed': elapsed,
+        }
+
+
+class JobManager(object):
+    """
+    Runs batch synthesis jobs on background threads.
+
+    Jobs run in submission order. Within a job the items are ordered by accent
+    and voice, so consecutive items reuse the loaded accent model and the cached
+    SE of the voice. ``run_item(item, format)`` returns
+    ``(encoded audio, audio seconds)``; ``workers`` items are in flight at once,
+    which lets concurrent conversions share batches. Only unfinished jobs are
+    kept in memory, finished ones are read back from disk.
+    """
+
+    def __init__(self, run_item, root='outputs/jobs', workers=1):
+        self.run_item = run_item
+        self.root = root
+        self.workers = workers
+        self._jobs = {}
+        self._sequence = 0
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+        self._start()
+        # Worker threads do not survive fork(), pre-forked server processes need their own
+        os.register_at_fork(after_in_child=self._start)
+
+    def _start(self):
+        self._queue = queue.PriorityQueue()
+        self._remaining = {}
+        self._threads = [threading.Thread(target=self._loop, name=f'job-worker-{i}', daemon=True)
+                         for i in range(self.workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, items, format='wav'):
+        job = Job(self.root, uuid.uuid4().hex, items, format, time.time())
+        os.makedirs(job.path)
+        job.save()
+        order = sorted(range(len(items)), key=lambda i: (items[i]['accent'], items[i]['voice'], i))
+        with self._lock:
+            self._jobs[job.id] = job
+            self._sequence += 1
+            self._remaining[job.id] = len(items)
+            for rank, index in enumerate(order):
+                self._queue.put((self._sequence, rank, job.id, index))
+        if not items:
+            self._finish(job)
+        return job
+
+    def get(self, job_id):
+        """Return a job running in this process, or read it back from disk."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is not None:
+            return job
+        if not job_id.isalnum() or not os.path.exists(os.path.join(self.root, job_id, 'job.json')):
+            return None
+        return Job.load(self.root, job_id)
+
+    def cancel(self, job_id):
+        """Stop a job: items that have not started are skipped, results so far are kept."""
+        job = self.get(job_id)
+        if job is None:
+            return None
+        job.cancelled = True
+        # The marker reaches the process running the job when it shares the directory
+        open(os.path.join(job.path, 'cancelled'), 'w').close()
+        return job
+
+    def delete(self, job_id):
+        job = self.cancel(job_id)
+        if job is not None:
+            with self._lock:
+                self._jobs.pop(job_id, None)
+            shutil.rmtree(job.path, ignore_errors=True)
+        return job
+
+    def expire(self, max_age):
+        """Delete the jobs that finished more than ``max_age`` seconds ago and return how many."""
+        cutoff = time.time() - max_age
+        expired = 0
+        for entry in os.scandir(self.root):
+            try:
+                job = self.get(entry.name) if entry.is_dir() else None
+            except (OSError, ValueError, KeyError):
+                continue
+            if job is not None and job.finished is not None and job.finished < cutoff:
+                self.delete(job.id)
+                expired += 1
+        return expired
+
+    def archive(self, job):
+        """Zip the results of a finished job (once) and return the path of the archive."""
+        archive_path = os.path.join(job.path, 'results.zip')
+        if not os.path.exists(archive_path):
+            fd, temp_path = tempfile.mkstemp(dir=job.path, prefix='results.zip.', suffix='.tmp')
+            os.close(fd)
+            # Compressed audio does not get smaller, store it as it is
+            with zipfile.ZipFile(temp_path, 'w', zipfile.ZIP_STORED) as archive:
+                for index in range(len(job.items)):
+                    if os.path.exists(job.result_path(index)):
+                        archive.write(job.result_path(index), os.path.basename(job.result_path(index)))
+                    elif os.path.exists(job.error_path(index)):
+                        archive.write(job.error_path(index), os.path.basename(job.error_path(index)))
+            os.replace(temp_path, archive_path)
+        return archive_path
+
+    def stats(self):
+        with self._lock:
+            return {
+                'jobs': len(self._jobs),
+                'running': sum(1 for job in self._jobs.values() if job.status in ('queued', 'running')),
+                'queued_items': self._queue.qsize(),
+            }
+
+    def _finish(self, job):
+        try:
+            if os.path.exists(job.path):
+                job.finished = time.time()
+                job.save()
+                logger.info(f'Job {job.id} finished: {job.succeeded} succeeded, {job.failed} failed '
+                            f'in {job.finished - (job.started or job.created):.1f}s')
+        except OSError as e:
+            logger.warning(f'Job {job.id} finished but could not be stored: {e}')
+        finally:
+            # From now on the job is read back from disk
+            with self._lock:
+                self._jobs.pop(job.id, None)
+
+    def _loop(self):
+        while True:
+            sequence, rank, job_id, index = self._queue.get()
+            with self._lock:
+                job = self._jobs.get(job_id)
+            # A failing item must not stop the worker, nor leave its job unfinished
+            try:
+                if job is not None and not job.cancelled and os.path.exists(os.path.join(job.path, 'cancelled')):
+                    job.cancelled = True
+                if job is not None and not job.cancelled:
+                    if job.started is None:
+                        job.started = time.time()
+                        job.save()
+                    self._run(job, index)
+            except OSError as e:
+                logger.warning(f'Job {job_id} item {index} could not be stored: {e}')
+            except Exception:
+                logger.exception(f'Job {job_id} item {index} failed')
+            with self._lock:
+                self._remaining[job_id] -= 1
+                done = self._remaining[job_id] == 0
+                if done:
+                    del self._remaining[job_id]
+            if done and job is not None:
+                self._finish(job)
+
+    def _run(self, job, index):
+        try:
+            content, audio_seconds = self.run_item(job.items[index], job.format)
+        except Exception as e:
+            with open(job.error_path(index), 'w') as f:
+                f.write(str(e))
+            with self._lock:
+                job.failed += 1
+            return
+        temp_path = job.result_path(index) + '.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(content)
+        os.replace(temp_path, job.result_path(index))
+        with self._lock:
+            job.succeeded += 1
+            job.audio_seconds += audio_seconds
@@ -0,0 +1,91 @@
+import asyncio
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Lifecycle(object):
+    """
+    Readiness and drain state of a server process.
+
+    The process is ready once its models are loaded and warm (``mark_ready``).
+    ``begin_drain`` is called when the process is asked to exit: from then on it
+    reports not ready and refuses new work, while the requests it has already
+    accepted get up to ``drain_timeout`` seconds to finish.
+    """
+
+    def __init__(self, drain_timeout=30.):
+        self.drain_timeout = drain_timeout
+        self.ready = False
+        self.draining = False
+        self.drain_started = None
+        self.in_flight = 0
+
+    def mark_ready(self):
+        self.ready = True
+
+    def begin_drain(self):
+        if not self.draining:
+            self.draining = True
+            self.drain_started = time.monotonic()
+            logger.info(f'Draining: refusing new work, waiting up to {self.drain_timeout:.0f}s for '
+                        f'{self.in_flight} request(s) in flight')
+
+    def remaining(self):
+        """Seconds left until the drain deadline."""
+        if self.drain_started is None:
+            return self.drain_timeout
+        return max(self.drain_timeout - (time.monotonic() - self.drain_started), 0.)
+
+    async def wait_idle(self, idle, interval=0.1):
+        """Wait until ``idle()`` is true or the drain deadline passes; returns whether it became idle."""
+        while not idle():
+            if self.remaining() <= 0:
+                return False
+            await asyncio.sleep(interval)
+        return True
+
+
+class DrainMiddleware(object):
+    """ASGI middleware counting requests in flight and refusing new ones with a 503 while draining."""
+
+    def __init__(self, app, lifecycle, exempt_paths=('/healthz', '/readyz', '/metrics')):
+        self.app = app
+        self.lifecycle = lifecycle
+        self.exempt_paths = set(exempt_paths)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] not in ('http', 'websocket'):
+            return await self.app(scope, receive, send)
+
+        if self.lifecycle.draining and scope['path'] not in self.exempt_paths:
+            if scope['type'] == 'websocket':
+                # Closing before accepting rejects the handshake
+                await send({'type': 'websocket.close', 'code': 1012})
+                return
+            await send({'type': 'http.response.start', 'status': 503,
+                        'headers': [(b'content-type', b'application/json'), (b'connection', b'close'),
+                                    (b'retry-after', b'1')]})
+            await send({'type': 'http.response.body', 'body': b'{"detail":"Server is shutting down."}'})
+            return
+
+        self.lifecycle.in_flight += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.lifecycle.in_flight -= 1
+
+
+def run_server(app, lifecycle, sockets=None, **config):
+    """Run uvicorn, entering drain mode as soon as it receives SIGTERM/SIGINT."""
+    import uvicorn
+
+    class DrainingServer(uvicorn.Server):
+        def handle_exit(self, sig, frame):
+            lifecycle.begin_drain()
+            super().handle_exit(sig, frame)
+
+    # uvicorn stops accepting connections and waits timeout_graceful_shutdown for open ones
+    server = DrainingServer(uvicorn.Config(app, timeout_graceful_shutdown=int(lifecycle.drain_timeout), **config))
+    server.run(sockets=sockets)
@@ -1,25 +1,43 @@
 """
 Main entrypoint for the OpenVoice FastAPI application.
 This module can be executed using: python -m openvoice.main
+
+With --workers N (N > 1) the models are loaded once and shared copy-on-write by
+N pre-forked server processes, see openvoice.prefork.
 """
 
 import sys
 import os
+import argparse
 
 # Add the current directory to the Python path to ensure proper imports
 current_dir = os.path.dirname(os.path.abspath(__file__))
 parent_dir = os.path.dirname(current_dir)
 sys.path.insert(0, parent_dir)
 
-from openvoice.openvoice_server import app
 
 def main():
     """Main function to start the FastAPI server."""
-    import uvicorn
+    parser = argparse.ArgumentParser(description="OpenVoice FastAPI server")
+    parser.add_argument('--host', type=str, default='0.0.0.0', help='Address to bind to')
+    parser.add_argument('--port', type=int, default=8000, help='Port to bind to')
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('OPENVOICE_WORKERS', 1)),
+                        help='Number of server processes sharing the loaded models (CPU only)')
+    parser.add_argument('--threads-per-worker', type=int, default=None,
+                        help='Intra-op torch threads per worker process. Defaults to cpu_count / workers')
+    args = parser.parse_args()
+
     print("Starting OpenVoice FastAPI server...")
-    print("Server will be available at: http://0.0.0.0:8000")
-    print("API documentation available at: http://0.0.0.0:8000/docs")
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    print(f"Server will be available at: http://{args.host}:{args.port}")
+    print(f"API documentation available at: http://{args.host}:{args.port}/docs")
+
+    if args.workers > 1:
+        from openvoice.prefork import serve
+        serve(host=args.host, port=args.port, workers=args.workers, threads_per_worker=args.threads_per_worker)
+    else:
+        from openvoice.lifecycle import run_server
+        from openvoice.openvoice_server import app, lifecycle
+        run_server(app, lifecycle, host=args.host, port=args.port)
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    main()
@@ -0,0 +1,229 @@
+"""
+Minimal Prometheus-style metrics for the synthesis pipeline.
+
+Metrics are rendered in the Prometheus text exposition format by ``render()``.
+Per-request stage timings are collected in a context variable, so pipeline code
+running on inference threads can report stages without the timings being passed
+around explicitly, and are turned into a ``Server-Timing`` header.
+"""
+
+import time
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_metrics = []
+_collectors = []
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in labels) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class _Metric(object):
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def _key(self, labels):
+        return tuple((name, labels[name]) for name in self.labelnames)
+
+    def header(self):
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        with self._lock:
+            return self.header() + [f'{self.name}{_format_labels(key)} {_format_value(value)}'
+                                    for key, value in self._values.items()]
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value)
+
+    def render(self):
+        lines = self.header()
+        with self._lock:
+            for key, (counts, total) in self._values.items():
+                for bound, count in zip(self.buckets, counts):
+                    lines.append(f'{self.name}_bucket{_format_labels(key + (("le", _format_value(bound)),))} {count}')
+                lines.append(f'{self.name}_sum{_format_labels(key)} {_format_value(total)}')
+                lines.append(f'{self.name}_count{_format_labels(key)} {counts[-1]}')
+        return lines
+
+
+def register_collector(collector):
+    """
+    Register a callable evaluated at scrape time.
+
+    It returns a list of (name, type, documentation, [(labels dict, value), ...])
+    tuples, for values that are owned by other components (caches, pools).
+    """
+    _collectors.append(collector)
+
+
+def render():
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    for collector in _collectors:
+        for name, metric_type, documentation, samples in collector():
+            lines.append(f'# HELP {name} {documentation}')
+            lines.append(f'# TYPE {name} {metric_type}')
+            for labels, value in samples:
+                lines.append(f'{name}{_format_labels(sorted(labels.items()))} {_format_value(value)}')
+    return '\n'.join(lines) + '\n'
+
+
+STAGE_SECONDS = Histogram('openvoice_stage_seconds', 'Latency of each synthesis pipeline stage.', ['stage'])
+REQUEST_SECONDS = Histogram('openvoice_request_seconds', 'End-to-end HTTP request latency.', ['path', 'status'])
+REQUEST_BYTES = Counter('openvoice_request_bytes_total', 'Bytes received in request bodies.', ['path'])
+RESPONSE_BYTES = Counter('openvoice_response_bytes_total', 'Bytes sent in response bodies.', ['path'])
+ACCENT_REQUESTS = Counter('openvoice_accent_requests_total', 'Synthesis requests per endpoint and accent.',
+                          ['endpoint', 'accent'])
+AUDIO_SECONDS = Counter('openvoice_audio_seconds_total', 'Seconds of audio produced.', ['endpoint'])
+REAL_TIME_FACTOR = Histogram('openvoice_real_time_factor', 'Wall-clock seconds spent per second of audio produced.',
+                             ['endpoint'], buckets=(0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1.0, 1.5, 2.0, 5.0))
+MODEL_LOADS = Counter('openvoice_model_loads_total', 'Model load events.', ['model'])
+MODEL_LOAD_SECONDS = Counter('openvoice_model_load_seconds_total', 'Seconds spent loading models.', ['model'])
+
+request_timings = contextvars.ContextVar('request_timings', default=None)
+
+
+def start_request():
+    """Start collecting stage timings for the current request and return them."""
+    timings = {}
+    request_timings.set(timings)
+    return timings
+
+
+def observe_stage(name, seconds):
+    STAGE_SECONDS.observe(seconds, stage=name)
+    timings = request_timings.get()
+    if timings is not None:
+        timings[name] = timings.get(name, 0.) + seconds
+
+
+@contextmanager
+def stage(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(name, time.perf_counter() - start)
+
+
+def observe_audio(endpoint, audio_seconds, wall_seconds):
+    AUDIO_SECONDS.inc(audio_seconds, endpoint=endpoint)
+    if audio_seconds > 0:
+        REAL_TIME_FACTOR.observe(wall_seconds / audio_seconds, endpoint=endpoint)
+
+
+def server_timing(timings):
+    """Format stage timings (in seconds) as a Server-Timing header value."""
+    return ', '.join(f'{name};dur={seconds * 1000:.1f}' for name, seconds in timings.items())
+
+
+startup_phases = {}
+
+
+@contextmanager
+def startup_phase(name):
+    """Time one phase of server startup; phases may run concurrently on different threads."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_startup_phase(name, time.perf_counter() - start)
+
+
+def record_startup_phase(name, seconds):
+    startup_phases[name] = seconds
+    logger.info(f'Startup phase {name} took {seconds:.2f}s')
+
+
+register_collector(lambda: [('openvoice_startup_phase_seconds', 'gauge', 'Duration of each server startup phase.',
+                             [({'phase': name}, seconds) for name, seconds in startup_phases.items()])])
+
+
+class MetricsMiddleware(object):
+    """ASGI middleware recording request latency and body bytes in and out per route."""
+
+    def __init__(self, app):
+        self.app = app
+        self._paths = None
+
+    def _path(self, scope):
+        if self._paths is None:
+            self._paths = {getattr(route, 'path', None) for route in getattr(scope.get('app'), 'routes', [])}
+        return scope['path'] if scope['path'] in self._paths else 'other'
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        path = self._path(scope)
+        start = time.perf_counter()
+        status = {'code': 500}
+
+        async def counting_receive():
+            message = await receive()
+            if message['type'] == 'http.request':
+                REQUEST_BYTES.inc(len(message.get('body', b'')), path=path)
+            return message
+
+        async def counting_send(message):
+            if message['type'] == 'http.response.start':
+                status['code'] = message['status']
+            elif message['type'] == 'http.response.body':
+                RESPONSE_BYTES.inc(len(message.get('body', b'')), path=path)
+            await send(message)
+
+        try:
+            await self.app(scope, counting_receive, counting_send)
+        finally:
+            REQUEST_SECONDS.observe(time.perf_counter() - start, path=path, status=str(status['code']))
@@ -0,0 +1,160 @@
+import os
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+def model_nbytes(model):
+    """Resident size of a torch module's parameters and buffers."""
+    if not hasattr(model, 'parameters'):
+        return 0
+    nbytes = sum(p.numel() * p.element_size() for p in model.parameters())
+    nbytes += sum(b.numel() * b.element_size() for b in model.buffers())
+    return nbytes
+
+
+class ModelPool(object):
+    """
+    Memory-budgeted pool of lazily loaded models.
+
+    Models are built by ``loader(key)`` on a background thread the first time
+    they are requested (or prefetched) and kept in LRU order. When the resident
+    size exceeds ``budget_bytes`` the least recently used models that are not
+    pinned, nor held with ``acquire``, are evicted. A budget of 0 means unlimited.
+    """
+
+    def __init__(self, loader, budget_bytes=0, pinned=(), max_loaders=1):
+        self.loader = loader
+        self.budget_bytes = budget_bytes
+        self.pinned = set(pinned)
+        self._models = OrderedDict()
+        self._sizes = {}
+        self.max_loaders = max_loaders
+        self._start()
+        # Loader threads do not survive fork(), pre-forked server processes need their own
+        os.register_at_fork(after_in_child=self._start)
+        self.loads = 0
+        self.evictions = 0
+        self.load_seconds = 0.
+
+    def _start(self):
+        self._loading = {}
+        self._in_use = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=self.max_loaders, thread_name_prefix='model-loader')
+
+    def __contains__(self, key):
+        return key in self._models
+
+    def keys(self):
+        with self._lock:
+            return list(self._models)
+
+    def _load(self, key):
+        start = time.time()
+        logger.info(f'Loading model {key}...')
+        model = self.loader(key)
+        elapsed = time.time() - start
+        nbytes = model_nbytes(model)
+        logger.info(f'...loaded model {key} ({nbytes / 2 ** 20:.0f} MB) in {elapsed:.1f}s')
+        with self._lock:
+            self._models[key] = model
+            self._sizes[key] = nbytes
+            self._loading.pop(key, None)
+            self.loads += 1
+            self.load_seconds += elapsed
+            self._evict(keep=key)
+        return model
+
+    def _evict(self, keep):
+        if not self.budget_bytes:
+            return
+        for key in list(self._models):
+            if sum(self._sizes.values()) <= self.budget_bytes:
+                break
+            if key == keep or key in self.pinned or key in self._in_use:
+                continue
+            del self._models[key]
+            del self._sizes[key]
+            self.evictions += 1
+            logger.info(f'Evicted model {key} to stay within the memory budget')
+
+    def load_async(self, key):
+        """Return a future for the model of ``key``, starting a background load if needed."""
+        with self._lock:
+            future = self._loading.get(key)
+            if future is not None:
+                return future
+            if key in self._models:
+                self._models.move_to_end(key)
+                future = Future()
+                future.set_result(self._models[key])
+                return future
+            future = self._loading[key] = self._executor.submit(self._load, key)
+
+        def forget_failed(f):
+            if f.exception() is not None:
+                with self._lock:
+                    self._loading.pop(key, None)
+
+        future.add_done_callback(forget_failed)
+        return future
+
+    def get(self, key):
+        """Return the model for ``key``, blocking until it is loaded."""
+        with self._lock:
+            if key in self._models:
+                self._models.move_to_end(key)
+                return self._models[key]
+        return self.load_async(key).result()
+
+    def wait(self):
+        """Block until every load in progress has finished."""
+        while True:
+            with self._lock:
+                futures = list(self._loading.values())
+            if not futures:
+                return
+            for future in futures:
+                future.exception()
+
+    def prefetch(self, keys):
+        for key in keys:
+            self.load_async(key)
+
+    def pin(self, key):
+        self.pinned.add(key)
+        return self.load_async(key)
+
+    def unpin(self, key):
+        self.pinned.discard(key)
+
+    def acquire(self, key):
+        """Like ``load_async``, and keep the model from being evicted until a matching ``release``."""
+        with self._lock:
+            self._in_use[key] = self._in_use.get(key, 0) + 1
+        return self.load_async(key)
+
+    def release(self, key):
+        with self._lock:
+            count = self._in_use.pop(key, 0) - 1
+            if count > 0:
+                self._in_use[key] = count
+
+    def stats(self):
+        with self._lock:
+            return {
+                'loaded': list(self._models),
+                'loading': list(self._loading),
+                'pinned': sorted(self.pinned),
+                'in_use': dict(self._in_use),
+                'bytes': sum(self._sizes.values()),
+                'budget_bytes': self.budget_bytes,
+                'loads': self.loads,
+                'evictions': self.evictions,
+                'load_seconds': self.load_seconds,
+            }
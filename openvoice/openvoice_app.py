@@ -127,14 +127,15 @@ def predict(prompt, style, audio_file_pth, agree):
             None,
         )
 
-    src_path = f'{output_dir}/tmp.wav'
-    tts_model.tts(prompt, src_path, speaker=style, language=language)
+    # Keep the base speaker audio in memory, the converter takes the waveform directly
+    src_audio = tts_model.tts(prompt, None, speaker=style, language=language)
 
     save_path = f'{output_dir}/output.wav'
     # Run the tone color converter
     encode_message = "@MyShell"
     tone_color_converter.convert(
-        audio_src_path=src_path, 
+        audio_src_path=src_audio,
+        sampling_rate=tts_model.hps.data.sampling_rate,
         src_se=source_se, 
         tgt_se=target_se, 
         output_path=save_path,
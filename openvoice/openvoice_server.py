@@ -1,20 +1,47 @@
 import os
 import time
+
+# Measured before the heavy imports below, which are part of cold start too
+startup_started = time.perf_counter()
+
+import asyncio
+import json
 import torch
 from melo.api import TTS
 import openvoice.se_extractor as se_extractor
 import io
 import magic
 import logging
+import shutil
+import tempfile
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 
-from fastapi import FastAPI, UploadFile, File, HTTPException, Form
+from fastapi import FastAPI, UploadFile, File, HTTPException, Form, Header, Request, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from starlette.responses import StreamingResponse
-from typing import Optional
+from starlette.formparsers import MultiPartParser, MultiPartException
+from starlette.responses import Response, StreamingResponse, FileResponse
+from typing import List, Optional
 from pydantic import BaseModel
 from openvoice.api import ToneColorConverter
+from openvoice.inference_pool import InferencePool, InferenceQueueFull
+from openvoice.admission import AdmissionController, AdmissionRejected
+from openvoice.jobs import JobManager
+from openvoice.se_jobs import SEExtractionQueue
+from openvoice.single_flight import SingleFlight
+from openvoice.lifecycle import Lifecycle, DrainMiddleware
+from openvoice.storage import StorageManager
+from openvoice.watermark_audit import WatermarkAuditor, iter_sources
+from openvoice.batching import ConversionBatcher
+from openvoice.voice_registry import VoiceRegistry
+from openvoice.model_pool import ModelPool
+from openvoice import metrics
+from openvoice.response_cache import ResponseCache, request_key, content_etag, etag_matches
+from openvoice.audio_io import (encode_audio, probe_duration, negotiate_format, format_media_type,
+                               AudioStreamEncoder, STREAM_FORMATS, encoding_rate)
 
 logging.basicConfig(level=logging.INFO)
+metrics.record_startup_phase('imports', time.perf_counter() - startup_started)
 
 app = FastAPI()
 
@@ -27,17 +54,18 @@ app.add_middleware(
     allow_headers=["*"],  # Allows all headers
 )
 
+# Request latency and bytes in/out per route, exported at /metrics
+app.add_middleware(metrics.MetricsMiddleware)
+
+# Readiness, and refusing new work while draining on shutdown
+lifecycle = Lifecycle(drain_timeout=float(os.environ.get('OPENVOICE_DRAIN_SECONDS', 30)))
+app.add_middleware(DrainMiddleware, lifecycle=lifecycle)
+
 # New checkpoint paths
 ckpt_base = 'checkpoints_v2/base_speakers/ses'
 
 device = "cuda:0" if torch.cuda.is_available() else "cpu"
 
-tone_color_converter = ToneColorConverter('checkpoints_v2/converter/config.json', device=device)
-tone_color_converter.load_ckpt('checkpoints_v2/converter/checkpoint.pth')
-
-output_dir = 'outputs'
-os.makedirs(output_dir, exist_ok=True)
-
 # Available base speakers
 base_speakers = ['en-au', 'en-br', 'en-default', 'en-india', 'en-newest', 'en-us', 'es', 'fr', 'jp', 'kr', 'zh']
 key_map = {'en-newest': ('EN-Newest', 'EN_NEWEST'),
@@ -53,48 +81,504 @@ key_map = {'en-newest': ('EN-Newest', 'EN_NEWEST'),
            'zh': ('ZH', 'ZH')
            }
 
-source_se = {
-    "en-newest": torch.load(f'{ckpt_base}/en-newest.pth').to(device),
-    "en-us": torch.load(f'{ckpt_base}/en-us.pth').to(device),
-    "en-br": torch.load(f'{ckpt_base}/en-br.pth').to(device),
-    "en-india": torch.load(f'{ckpt_base}/en-india.pth').to(device),
-    "en-au": torch.load(f'{ckpt_base}/en-au.pth').to(device),
-    "en-default": torch.load(f'{ckpt_base}/en-default.pth').to(device),
-    "es": torch.load(f'{ckpt_base}/es.pth').to(device),
-    "fr": torch.load(f'{ckpt_base}/fr.pth').to(device),
-    "jp": torch.load(f'{ckpt_base}/jp.pth').to(device),
-    "kr": torch.load(f'{ckpt_base}/kr.pth').to(device),
-    "zh": torch.load(f'{ckpt_base}/zh.pth').to(device)
-}
-logging.info('Loaded base speakers.')
-logging.info('Loading TTS models...')
-model = {}
 
-# When running on CPU, only load the en-newest model
+def accent_language(accent):
+    """The Melo language model that speaks `accent`; accents of one language differ only in speaker ID."""
+    return key_map[accent][1]
+
+
+def accent_label(accent):
+    """`accent` as a metrics label: unknown accents share one series, so clients cannot add series at will."""
+    return accent if accent in key_map else 'invalid'
+
+
+def load_language_model(language):
+    start = time.perf_counter()
+    tts_model = TTS(language=language, device=device)
+    metrics.MODEL_LOADS.inc(model=language)
+    metrics.MODEL_LOAD_SECONDS.inc(time.perf_counter() - start, model=language)
+    return tts_model
+
+
+def load_converter():
+    with metrics.startup_phase('converter'):
+        converter = ToneColorConverter('checkpoints_v2/converter/config.json', device=device)
+        converter.load_ckpt('checkpoints_v2/converter/checkpoint.pth')
+    return converter
+
+
+def load_source_ses(accents, packed_name='packed.pth'):
+    """
+    Load the base speaker SEs from a single packed file.
+
+    The packed file is (re)built from the per-accent files, read in parallel, whenever
+    it is missing or older than any of them.
+    """
+    with metrics.startup_phase('source_ses'):
+        paths = {accent: os.path.join(ckpt_base, f'{accent}.pth') for accent in accents}
+        packed_path = os.path.join(ckpt_base, packed_name)
+        ses = None
+        try:
+            if os.path.getmtime(packed_path) >= max(os.path.getmtime(path) for path in paths.values()):
+                ses = torch.load(packed_path, map_location='cpu')
+        except (OSError, RuntimeError) as e:
+            logging.info(f'Rebuilding {packed_path}: {e}')
+        if ses is None or not set(accents) <= set(ses):
+            with ThreadPoolExecutor(max_workers=len(paths), thread_name_prefix='se-loader') as executor:
+                ses = dict(zip(paths, executor.map(lambda path: torch.load(path, map_location='cpu'),
+                                                   paths.values())))
+            try:
+                torch.save(ses, packed_path + '.tmp')
+                os.replace(packed_path + '.tmp', packed_path)
+            except OSError as e:
+                logging.warning(f'Could not write {packed_path}: {e}')
+        return {accent: ses[accent].to(device) for accent in accents}
+
+
+def refresh_voice_registry():
+    with metrics.startup_phase('voice_registry'):
+        voice_registry.refresh()
+
+
+pinned_accents = [accent for accent in os.environ.get('OPENVOICE_PINNED_ACCENTS', 'en-newest').split(',')
+                  if accent in key_map]
+
+# TTS models are keyed by language, so the English accents share one model. They are loaded in
+# the background on first use and evicted least recently used first once their resident size
+# exceeds the budget (0 = unlimited)
+model_pool = ModelPool(load_language_model,
+                       budget_bytes=int(os.environ.get('OPENVOICE_MODEL_BUDGET_MB', 0)) * 1024 * 1024,
+                       pinned=[accent_language(accent) for accent in pinned_accents],
+                       max_loaders=int(os.environ.get('OPENVOICE_MODEL_LOADERS', 2)))
+
+# When running on CPU, only preload the en-newest model
 if device == "cpu":
     base_speakers = ['en-newest']
 
-for accent in base_speakers:
-    logging.info(f'Loading {accent}...')
-    model[accent] = TTS(language=key_map[accent][1], device=device)
-    logging.info('...done.')
+# Start loading the accent models first, they take longest
+logging.info('Loading TTS models in the background...')
+model_pool.prefetch(dict.fromkeys(sorted(model_pool.pinned) +
+                                  [accent_language(accent) for accent in base_speakers]))
+
+# Exact label -> reference audio index over resources/, persisted in resources/.voices.json
+voice_registry = VoiceRegistry('resources')
+
+# The converter, the base speaker SEs and the voice index don't depend on each other
+with ThreadPoolExecutor(max_workers=3, thread_name_prefix='startup') as startup_executor:
+    converter_future = startup_executor.submit(load_converter)
+    source_se_future = startup_executor.submit(load_source_ses, list(key_map))
+    registry_future = startup_executor.submit(refresh_voice_registry)
+tone_color_converter = converter_future.result()
+source_se = source_se_future.result()
+registry_future.result()
+logging.info('Loaded base speakers.')
+
+if float(os.environ.get('OPENVOICE_VOICE_WATCH_SECONDS', 0)) > 0:
+    voice_registry.watch(float(os.environ['OPENVOICE_VOICE_WATCH_SECONDS']))
+
+# Memory budget of the in-process speaker embedding cache (the on-disk tier lives in processed/)
+se_extractor.se_cache.max_bytes = int(os.environ.get('OPENVOICE_SE_CACHE_MB', 64)) * 1024 * 1024
+
+# Optional cache of final /synthesize_speech/ responses (0 MB = disabled), spilling to outputs/response_cache
+response_cache = None
+if int(os.environ.get('OPENVOICE_RESPONSE_CACHE_MB', 0)) > 0:
+    response_cache = ResponseCache(int(os.environ['OPENVOICE_RESPONSE_CACHE_MB']) * 1024 * 1024,
+                                   spill_dir='outputs/response_cache',
+                                   max_disk_bytes=int(os.environ.get('OPENVOICE_RESPONSE_CACHE_DISK_MB', 0)) * 1024 * 1024)
+
+# Blocking inference runs on this pool so the event loop keeps serving requests
+inference_pool = InferencePool(max_workers=int(os.environ.get('OPENVOICE_INFERENCE_WORKERS', 1)),
+                               max_queue=int(os.environ.get('OPENVOICE_INFERENCE_QUEUE', 16)))
+
+# Speaker embeddings of uploaded voices are extracted in the background, before their first use
+se_jobs = SEExtractionQueue(workers=1)
+
+# Bulk watermark checks decode uploads in a pool of processes, started on first use
+watermark_auditor = WatermarkAuditor(tone_color_converter,
+                                     processes=int(os.environ.get('OPENVOICE_AUDIT_PROCESSES', os.cpu_count() or 1)))
+
+# Identical requests (and SE extractions) in flight at the same time are computed once and shared
+synthesis_flight = SingleFlight()
+se_flight = SingleFlight()
+
+# /readyz fails while more inference jobs than this are waiting, so load balancers back off
+ready_max_queued = int(os.environ.get('OPENVOICE_READY_MAX_QUEUED', max(1, inference_pool.max_queue // 2)))
+
+# Work is admitted by its estimated seconds of audio; past the high-water mark (0 = unlimited) requests get a 429
+admission = AdmissionController(high_water=float(os.environ.get('OPENVOICE_MAX_INFLIGHT_AUDIO_SECONDS', 0)))
+
+# Conversions that reach the converter within the batch window run as one forward pass. A single
+# inference worker never has a second conversion to wait for, so it doesn't wait
+conversion_batcher = ConversionBatcher(tone_color_converter,
+                                       max_batch_size=int(os.environ.get('OPENVOICE_BATCH_SIZE', 8)),
+                                       window=float(os.environ.get('OPENVOICE_BATCH_WINDOW_MS', 5)) / 1000
+                                       if inference_pool.max_workers > 1 else 0.,
+                                       lock=inference_pool.model_lock('converter'))
+
+
+# Batch synthesis jobs, with their results in outputs/jobs
+job_manager = JobManager(lambda item, format: run_job_item(item, format), root='outputs/jobs',
+                         workers=int(os.environ.get('OPENVOICE_JOB_WORKERS', inference_pool.max_workers)))
+
+
+def live_voice_hashes():
+    """The hashes of the voices in resources/, including those uploaded through other server processes."""
+    voice_registry.refresh()
+    return voice_registry.hashes()
+
+
+def forget_voice_se(audio_names):
+    """Reset the SE state of the voices whose cached SE the storage sweep removed."""
+    voice_registry.clear_se(os.path.join('processed', audio_name, 'se.pth') for audio_name in audio_names)
+
+
+# Derived artifacts on disk (segments and SEs in processed/, finished jobs) are kept within budgets (0 = unlimited)
+storage = StorageManager(processed_dir='processed', resources_dir='resources', outputs_dir='outputs', jobs=job_manager,
+                         max_processed_bytes=int(os.environ.get('OPENVOICE_PROCESSED_MAX_MB', 0)) * 1024 * 1024,
+                         processed_ttl=float(os.environ.get('OPENVOICE_PROCESSED_TTL_HOURS', 0)) * 3600,
+                         job_ttl=float(os.environ.get('OPENVOICE_JOB_TTL_HOURS', 0)) * 3600,
+                         min_free_bytes=int(os.environ.get('OPENVOICE_MIN_FREE_DISK_MB', 0)) * 1024 * 1024,
+                         live_hashes=live_voice_hashes,
+                         in_use=lambda: {audio_hash for audio_hash, _ in se_extractor.se_cache.keys()},
+                         on_evict=forget_voice_se)
+if float(os.environ.get('OPENVOICE_STORAGE_SWEEP_SECONDS', 600)) > 0:
+    storage.start(float(os.environ.get('OPENVOICE_STORAGE_SWEEP_SECONDS', 600)))
+
+
+def collect_component_metrics():
+    """Expose the state of the caches, pools and batcher at scrape time."""
+    se_stats = se_extractor.se_cache.stats()
+    pool_stats = model_pool.stats()
+    admission_stats = admission.stats()
+    storage_stats = storage.stats()
+    samples = [
+        ('openvoice_se_cache_bytes', 'gauge', 'Bytes held by the in-memory SE cache.', [({}, se_stats['bytes'])]),
+        ('openvoice_se_cache_lookups_total', 'counter', 'SE cache lookups by result.',
+         [({'result': result}, se_stats[result]) for result in ('hits', 'disk_hits', 'misses')]),
+        ('openvoice_model_pool_bytes', 'gauge', 'Bytes held by loaded TTS language models.',
+         [({}, pool_stats['bytes'])]),
+        ('openvoice_model_pool_loaded', 'gauge', 'TTS language models currently loaded.',
+         [({}, len(pool_stats['loaded']))]),
+        ('openvoice_model_pool_evictions_total', 'counter', 'TTS language models evicted from the pool.',
+         [({}, pool_stats['evictions'])]),
+        ('openvoice_inference_queued', 'gauge', 'Inference jobs waiting for a worker.', [({}, inference_pool.queued)]),
+        ('openvoice_inference_running', 'gauge', 'Inference jobs currently running.', [({}, inference_pool.running)]),
+        ('openvoice_admission_in_flight_seconds', 'gauge', 'Estimated seconds of audio admitted and not finished.',
+         [({}, admission_stats['in_flight_seconds'])]),
+        ('openvoice_admission_rejected_total', 'counter', 'Requests rejected with a 429 by admission control.',
+         [({}, admission_stats['rejected'])]),
+        ('openvoice_coalesced_requests_total', 'counter', 'Requests that shared the result of an identical request.',
+         [({'kind': 'synthesis'}, synthesis_flight.shared), ({'kind': 'se'}, se_flight.shared)]),
+        ('openvoice_se_extractions_pending', 'gauge', 'Background speaker embedding extractions queued or running.',
+         [({}, se_jobs.pending)]),
+        ('openvoice_job_queued_items', 'gauge', 'Batch job items waiting to be synthesized.',
+         [({}, job_manager.stats()['queued_items'])]),
+        ('openvoice_storage_bytes', 'gauge', 'Bytes on disk per storage area, as of the last sweep.',
+         [({'area': area}, stats['bytes']) for area, stats in storage_stats['areas'].items()]),
+        ('openvoice_storage_evictions_total', 'counter', 'Files and directories removed by the storage sweep.',
+         [({'reason': reason}, count) for reason, count in storage_stats['evicted'].items()]),
+        ('openvoice_disk_free_bytes', 'gauge', 'Free space on the disk holding processed/.',
+         [({}, storage_stats['disk']['free_bytes'])]),
+        ('openvoice_conversion_batches_total', 'counter', 'Batched voice conversion forward passes.',
+         [({}, conversion_batcher.batches)]),
+        ('openvoice_conversion_batch_items_total', 'counter', 'Conversions run through the batcher.',
+         [({}, conversion_batcher.items)]),
+    ]
+    if response_cache is not None:
+        cache_stats = response_cache.stats()
+        samples += [
+            ('openvoice_response_cache_bytes', 'gauge', 'Bytes held by the response cache.',
+             [({'tier': 'memory'}, cache_stats['bytes']), ({'tier': 'disk'}, cache_stats['disk_bytes'])]),
+            ('openvoice_response_cache_lookups_total', 'counter', 'Response cache lookups by result.',
+             [({'result': result}, cache_stats[result]) for result in ('hits', 'disk_hits', 'misses')]),
+        ]
+    return samples
+
+
+metrics.register_collector(collect_component_metrics)
+
+
+def get_model(accent):
+    """Return the TTS model for `accent`, loading it on first use."""
+    return model_pool.get(accent_language(accent))
+
+
+async def ensure_model(accent):
+    """Wait for `accent` to be loaded without holding up an inference worker."""
+    if accent not in key_map:
+        raise HTTPException(status_code=400, detail=f"Unknown accent {accent}.")
+    await asyncio.wrap_future(model_pool.load_async(accent_language(accent)))
+
+
+def accent_model_stats():
+    """The state of the model pool, and the language model each accent is served by."""
+    return dict(model_pool.stats(), accents={accent: accent_language(accent) for accent in key_map})
+
+
+def run_tts(accent, text, speed):
+    """Run the base speaker TTS and return (audio, sampling_rate)."""
+    tts_model = get_model(accent)
+    with inference_pool.model_lock(f'tts:{accent_language(accent)}'), metrics.stage('tts'):
+        audio = tts_model.tts_to_file(text, tts_model.hps.data.spk2id[key_map[accent][0]], None, speed=speed)
+    return audio, tts_model.hps.data.sampling_rate
+
+
+def extract_voice_se(voice):
+    """Extract (or load) the target SE of a voice registry entry and record the outcome in the registry."""
+    try:
+        target_se, audio_name = se_extractor.get_se(voice['path'], tone_color_converter, target_dir='processed',
+                                                    vad=True, lock=inference_pool.model_lock('converter'),
+                                                    audio_hash=voice['hash'], keep_segments=False)
+    except Exception as e:
+        voice_registry.update(voice['label'], audio_hash=voice['hash'], se_state='failed', se_error=str(e))
+        raise
+    voice_registry.update(voice['label'], audio_hash=voice['hash'], se_state='ready', se_error=None,
+                          se_path=os.path.join('processed', audio_name, 'se.pth'))
+    return target_se, audio_name
+
+
+def run_get_se(voice):
+    """Return the target SE of a voice registry entry, waiting for its extraction if one is under way."""
+    with metrics.stage('se'):
+        pending = se_jobs.get(voice['hash'])
+        if pending is not None:
+            return pending.result()
+        target_se, audio_name = se_flight.do(voice['hash'], extract_voice_se, voice)[0]
+        return target_se, audio_name
+
+
+def run_convert(audio_src, src_se, tgt_se, message, sampling_rate=None):
+    """
+    Convert `audio_src`, a file or a waveform sampled at `sampling_rate`, to the target voice.
+
+    The watermark `message` is left out when None; the streaming endpoints watermark the whole stream instead.
+    """
+    with metrics.stage('convert'):
+        audio = tone_color_converter.convert(
+            audio_src_path=audio_src,
+            src_se=src_se,
+            tgt_se=tgt_se,
+            message=None,
+            batcher=conversion_batcher,
+            sampling_rate=sampling_rate)
+    if message is None:
+        return audio
+    with metrics.stage('watermark'):
+        return tone_color_converter.add_watermark(audio, message)
+
+
+def run_stream_watermark(watermarker, audio):
+    with metrics.stage('watermark'):
+        return watermarker.write(audio)
+
+
+def run_synthesis(text, reference_voice, accent, speed, watermark, seed=None):
+    """Run the full pipeline for one request and return the converted audio."""
+    target_se, audio_name = run_get_se(reference_voice)
+
+    if seed is not None:
+        # Identical requests sample the same noise, so their output is reproducible
+        # (exactly so with a single inference worker)
+        torch.manual_seed(seed)
+
+    # Run the base speaker tts
+    audio, sampling_rate = run_tts(accent, text, speed)
+
+    # Run the tone color converter on the TTS output as it is, without encoding it in between
+    return run_convert(audio, source_se[accent], target_se, watermark, sampling_rate)
+
+
+def run_split_sentences(accent, text):
+    tts_model = get_model(accent)
+    return tts_model.split_sentences_into_pieces(text, tts_model.language, quiet=True)
 
-logging.info('Loaded TTS models.')
+
+def run_sentence(sentence, accent, speed, target_se, watermark):
+    """Synthesize and convert a single sentence for the streaming endpoints."""
+    audio, sampling_rate = run_tts(accent, sentence, speed)
+    return run_convert(audio, source_se[accent], target_se, watermark, sampling_rate)
+
+
+def run_job_item(item, format):
+    """Synthesize one batch job item the same way /synthesize_speech/ would and return (content, audio seconds)."""
+    reference_voice = find_voice(item['voice'])
+    if reference_voice is None:
+        raise ValueError("No matching voice found.")
+    get_model(item['accent'])
+    cache_key = request_key(text=item['text'], voice=reference_voice['hash'], accent=item['accent'],
+                            speed=item['speed'], watermark=item['watermark'], format=format,
+                            version=tone_color_converter.version)
+    # Interactive requests fill the queue, wait for room instead of failing the item
+    future = inference_pool.submit_when_room(run_synthesis, item['text'], reference_voice, item['accent'],
+                                             item['speed'], item['watermark'], int(cache_key[:8], 16))
+    audio = future.result()
+    sampling_rate = tone_color_converter.hps.data.sampling_rate
+    return encode_audio(audio, sampling_rate, format), len(audio) / sampling_rate
+
+
+def find_voice(voice):
+    # The 'voice' parameter must match the 'audio_file_label' used while uploading
+    return voice_registry.lookup(str(voice))
+
+
+def run_change_voice(audio_src, reference_voice, watermark):
+    target_se, audio_name = run_get_se(reference_voice)
+    return run_convert(audio_src, source_se['en-newest'], target_se, watermark)
+
+
+def response_format(format, accept, allowed=None):
+    """Resolve the requested output format, rejecting unknown explicit formats with a 400."""
+    try:
+        if allowed is None:
+            return negotiate_format(format, accept)
+        return negotiate_format(format, accept, allowed=allowed)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+def audio_response(audio, sampling_rate, format):
+    content = encode_audio(audio, sampling_rate, format)
+    return Response(content, media_type=format_media_type(format), headers={"Vary": "Accept"})
+
+
+def admission_error(e):
+    return HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+
+
+class AdmittedStreamingResponse(StreamingResponse):
+    """
+    A StreamingResponse that holds an admission reservation of `cost` until it ends.
+
+    The reservation is released once however the response ends, also when the client goes away
+    before the body generator has started (its own `finally` would then never run).
+    """
+
+    def __init__(self, content, cost, **kwargs):
+        super().__init__(content, **kwargs)
+        self.cost = cost
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            admission.release(self.cost)
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.release()
+
+
+def set_server_timing(result, endpoint, timings, start_time, audio_seconds=0.):
+    """Export the audio produced by a request and attach its per-stage breakdown."""
+    elapsed = time.perf_counter() - start_time
+    if audio_seconds:
+        metrics.observe_audio(endpoint, audio_seconds, elapsed)
+    timings['total'] = elapsed
+    result.headers["Server-Timing"] = metrics.server_timing(timings)
 
 
 class UploadAudioRequest(BaseModel):
     audio_file_label: str
 
 
+class PrefetchAccentsRequest(BaseModel):
+    accents: List[str]
+
+
+class JobItem(BaseModel):
+    text: str
+    voice: str
+    accent: Optional[str] = 'en-newest'
+    speed: Optional[float] = 1.0
+    watermark: Optional[str] = "@MyShell"
+
+
+class SynthesisJobRequest(BaseModel):
+    items: List[JobItem]
+    format: Optional[str] = 'wav'
+
+
+def run_warmup(accent):
+    """
+    Run the TTS, converter and watermark models once on synthetic input.
+
+    This initialises their kernels and allocator pools without the SE extraction
+    a full synthesis with a reference voice would also run; the VAD that
+    extraction needs is warmed up separately, once.
+    """
+    tts_model = get_model(accent)
+    with inference_pool.model_lock(f'tts:{accent_language(accent)}'):
+        tts_model.tts_to_file("Warm up.", tts_model.hps.data.spk2id[key_map[accent][0]], None, quiet=True)
+    # 3 seconds at 16 kHz, enough for the two watermark chunks of the default message
+    noise = np.random.default_rng(0).uniform(-0.1, 0.1, 48000).astype(np.float32)
+    with inference_pool.model_lock('converter'):
+        spec = tone_color_converter.spectrogram(noise[:16000])
+        tone_color_converter.convert_batch([spec], [source_se[accent]], [source_se[accent]])
+        tone_color_converter.add_watermark(noise, "@MyShell")
+
+
 @app.on_event("startup")
 async def startup_event():
-    test_text = "This is a test sentence generated by the OpenVoice API."
-    voice = "demo_speaker0"
-    await synthesize_speech(test_text, voice)
+    # One accent per language is enough to load and warm up its model
+    for accent in {accent_language(accent): accent for accent in pinned_accents or ['en-newest']}.values():
+        with metrics.startup_phase(f'load_{accent}'):
+            await ensure_model(accent)
+        with metrics.startup_phase(f'warmup_{accent}'):
+            await inference_pool.run(run_warmup, accent)
+    # Uploads and SE extractions need the VAD; fetch it now rather than in the first such request
+    with metrics.startup_phase('warmup_vad'):
+        await inference_pool.run(se_extractor.warmup_vad)
+    metrics.record_startup_phase('total', time.perf_counter() - startup_started)
+    lifecycle.mark_ready()
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    # uvicorn has waited for the open requests; let work they left on the inference pool finish too
+    lifecycle.begin_drain()
+    if not await lifecycle.wait_idle(lambda: inference_pool.queued + inference_pool.running == 0):
+        logging.warning(f'Drain deadline passed with {inference_pool.queued + inference_pool.running} '
+                        f'inference job(s) unfinished')
+    # Voice index changes are written in the background; don't lose the last ones
+    await asyncio.to_thread(voice_registry.flush)
+
+
+@app.get("/healthz")
+async def healthz():
+    """
+    Liveness probe: the process is up and its event loop responds.
+
+    :return: {"status": "ok"}
+    :rtype: dict
+    """
+    return {"status": "ok"}
+
+
+@app.get("/readyz")
+async def readyz():
+    """
+    Readiness probe: the models are loaded and warm, the inference queue is below its threshold and
+    the server is not draining. Answers 503 otherwise, with the failing checks.
+
+    :return: The individual checks.
+    :rtype: dict
+    """
+    checks = {
+        "warm": lifecycle.ready,
+        "models_loaded": all(language in model_pool for language in model_pool.pinned),
+        "queue_ok": inference_pool.queued < ready_max_queued,
+        "draining": lifecycle.draining,
+    }
+    ready = checks["warm"] and checks["models_loaded"] and checks["queue_ok"] and not checks["draining"]
+    return Response(json.dumps(dict(checks, ready=ready)), status_code=200 if ready else 503,
+                    media_type="application/json")
 
 
 @app.get("/base_tts/")
-async def base_tts(text: str, accent: Optional[str] = 'en-newest', speed: Optional[float] = 1.0):
+async def base_tts(text: str, accent: Optional[str] = 'en-newest', speed: Optional[float] = 1.0,
+                   format: Optional[str] = None, accept: Optional[str] = Header(None)):
     """
     Perform text-to-speech conversion using only the base speaker.
 
@@ -104,27 +588,36 @@ async def base_tts(text: str, accent: Optional[str] = 'en-newest', speed: Option
     :type accent: str, optional
     :param speed: The speed of the synthesized speech, defaults to 1.0.
     :type speed: float, optional
+    :param format: The output format (wav, flac, opus or mp3). Negotiated from the Accept header when omitted.
+    :type format: str, optional
     :return: The speech audio.
-    :rtype: .wav file
+    :rtype: audio file
     """
-    global model
-
-    if accent not in model:
-        logging.info(f'Loading {accent}...')
-        model[accent] = TTS(language=key_map[accent][1], device=device)
-        logging.info('...done.')
-
+    format = response_format(format, accept)
+    timings = metrics.start_request()
+    start_time = time.perf_counter()
+    metrics.ACCENT_REQUESTS.inc(endpoint='base_tts', accent=accent_label(accent))
     try:
-        save_path = f'{output_dir}/output_v2_{accent}.wav'
-        model[accent].tts_to_file(text, model[accent].hps.data.spk2id[key_map[accent][0]], save_path, speed=speed)
-        result = StreamingResponse(open(save_path, 'rb'), media_type="audio/wav")
+        with admission.admit(admission.estimate(text, speed)):
+            await ensure_model(accent)
+            audio, sampling_rate = await inference_pool.run(run_tts, accent, text, speed)
+            with metrics.stage('encode'):
+                result = audio_response(audio, sampling_rate, format)
+        set_server_timing(result, 'base_tts', timings, start_time, len(audio) / sampling_rate)
         return result
+    except HTTPException:
+        raise
+    except AdmissionRejected as e:
+        raise admission_error(e)
+    except InferenceQueueFull as e:
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
 @app.post("/change_voice/")
-async def change_voice(reference_speaker: str = Form(...), file: UploadFile = File(...), watermark: Optional[str] = "@MyShell"):
+async def change_voice(reference_speaker: str = Form(...), file: UploadFile = File(...), watermark: Optional[str] = "@MyShell",
+                       format: Optional[str] = None, accept: Optional[str] = Header(None)):
     """
     Change the voice of an existing audio file.
 
@@ -134,9 +627,14 @@ async def change_voice(reference_speaker: str = Form(...), file: UploadFile = Fi
     :type file: UploadFile
     :param watermark: The watermark to be encoded in the voice conversion, defaults to '@MyShell'.
     :type watermark: str, optional
+    :param format: The output format (wav, flac, opus or mp3). Negotiated from the Accept header when omitted.
+    :type format: str, optional
     :return: The audio file with the changed voice.
-    :rtype: .wav file
+    :rtype: audio file
     """
+    format = response_format(format, accept)
+    timings = metrics.start_request()
+    start_time = time.perf_counter()
     try:
         logging.info(f'changing voice to {reference_speaker}...')
 
@@ -145,68 +643,195 @@ async def change_voice(reference_speaker: str = Form(...), file: UploadFile = Fi
 
         contents = await file.read()
         temp_file = io.BytesIO(contents)
-        matching_files = [file for file in os.listdir("resources") if file.startswith(str(reference_speaker))]
-        if not matching_files:
+        reference_voice = await asyncio.to_thread(find_voice, reference_speaker)
+        if reference_voice is None:
             raise HTTPException(status_code=400, detail="No matching reference speaker found.")
-        reference_speaker_file = f'resources/{matching_files[0]}'
-        target_se, audio_name = se_extractor.get_se(reference_speaker_file, tone_color_converter, target_dir='processed', vad=True)
-        save_path = f'{output_dir}/output_v2_{reference_speaker}.wav'
-        tone_color_converter.convert(
-            audio_src_path=temp_file,
-            src_se=source_se['en-newest'],
-            tgt_se=target_se,
-            output_path=save_path,
-            message=watermark)
-        result = StreamingResponse(open(save_path, 'rb'), media_type="audio/wav")
+        sampling_rate = tone_color_converter.hps.data.sampling_rate
+        with admission.admit(probe_duration(contents)):
+            audio = await inference_pool.run(run_change_voice, temp_file, reference_voice, watermark)
+            with metrics.stage('encode'):
+                result = audio_response(audio, sampling_rate, format)
+        set_server_timing(result, 'change_voice', timings, start_time, len(audio) / sampling_rate)
         return result
+    except HTTPException:
+        raise
+    except AdmissionRejected as e:
+        raise admission_error(e)
+    except InferenceQueueFull as e:
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.post("/upload_audio/")
-async def upload_audio(audio_file_label: str = Form(...), file: UploadFile = File(...)):
+# Uploads are streamed to disk; bodies larger than this are cut off as soon as they exceed it
+max_upload_bytes = int(os.environ.get('OPENVOICE_MAX_UPLOAD_MB', 5)) * 1024 * 1024
+
+
+async def read_upload_form(request, max_bytes):
+    """
+    Parse a multipart upload without holding it in memory.
+
+    The parser spools file parts to temporary files; the body is rejected with a 413
+    as soon as it grows past `max_bytes`, without reading the rest of it.
+    """
+    too_large = HTTPException(status_code=413,
+                              detail=f"File size is over limit. Max size is {max_upload_bytes // 2 ** 20}MB.")
+    content_length = request.headers.get('content-length')
+    if content_length is not None and content_length.isdigit() and int(content_length) > max_bytes:
+        raise too_large
+
+    async def limited_stream():
+        received = 0
+        async for chunk in request.stream():
+            received += len(chunk)
+            if received > max_bytes:
+                raise too_large
+            yield chunk
+
+    if not request.headers.get('content-type', '').startswith('multipart/form-data'):
+        raise HTTPException(status_code=400, detail="Expected a multipart/form-data upload.")
+    parser = MultiPartParser(request.headers, limited_stream(), max_files=1, max_fields=8)
+    try:
+        return await parser.parse()
+    except MultiPartException as e:
+        raise HTTPException(status_code=400, detail=e.message)
+
+
+def store_upload(upload, directory, extension, max_bytes, chunk_size=64 * 1024):
+    """
+    Copy an uploaded file into a hidden temporary file in `directory`, chunk by chunk.
+
+    Returns the temporary path, the file size and its first bytes for MIME sniffing,
+    or None (and no file) when the file is larger than `max_bytes`.
+    """
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.upload-', suffix=f'.{extension}')
+    size = 0
+    header = b''
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            while True:
+                chunk = upload.file.read(chunk_size)
+                if not chunk:
+                    break
+                if not header:
+                    header = chunk[:2048]
+                size += len(chunk)
+                if size > max_bytes:
+                    os.remove(temp_path)
+                    return None
+                f.write(chunk)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return temp_path, size, header
+
+
+@app.post("/upload_audio/", openapi_extra={
+    "requestBody": {"content": {"multipart/form-data": {"schema": {
+        "type": "object",
+        "required": ["audio_file_label", "file"],
+        "properties": {"audio_file_label": {"type": "string"}, "file": {"type": "string", "format": "binary"}},
+    }}}, "required": True}})
+async def upload_audio(request: Request):
     """
     Upload an audio file for later use as the reference audio.
 
-    :param audio_file_label: The label for the audio file.
-    :param file: The audio file to be uploaded.
-    :type file: UploadFile
+    The multipart form holds `audio_file_label`, the label for the audio file, and `file`,
+    the audio file to be uploaded. The file is streamed to disk and moved into the voice
+    store once its size and content type have been checked.
+
+    :param request: The multipart upload.
+    :type request: Request
     :return: Confirmation of successful upload.
     :rtype: dict
     """
+    form = await read_upload_form(request, max_upload_bytes + 64 * 1024)
+    temp_path = None
     try:
-        contents = await file.read()
+        audio_file_label = form.get('audio_file_label')
+        file = form.get('file')
+        if not isinstance(audio_file_label, str) or not audio_file_label or not hasattr(file, 'filename'):
+            raise HTTPException(status_code=400, detail="Expected the form fields audio_file_label and file.")
+        if os.path.basename(audio_file_label) != audio_file_label or audio_file_label.startswith('.'):
+            raise HTTPException(status_code=400, detail="Invalid audio_file_label.")
 
         allowed_extensions = {'wav', 'mp3', 'flac', 'ogg'}
-        max_file_size = 5 * 1024 * 1024  # 5MB
 
-        if not file.filename.split('.')[-1] in allowed_extensions:
+        # Use provided 'audio_file_label' for stored file's name.
+        # We retain the file extension to ensure appropriate processing later.
+        file_extension = (file.filename or '').split('.')[-1]
+        if file_extension not in allowed_extensions:
             return {"error": "Invalid file type. Allowed types are: wav, mp3, flac, ogg"}
 
-        if len(contents) > max_file_size:
-            return {"error": "File size is over limit. Max size is 5MB."}
+        # Make sure the resources directory exists
+        os.makedirs("resources", exist_ok=True)
 
-        # Note: we need to first write the file in order to check magic.
-        temp_file = io.BytesIO(contents)
-        file_format = magic.from_buffer(temp_file.read(), mime=True)
+        stored = await asyncio.to_thread(store_upload, file, "resources", file_extension, max_upload_bytes)
+        if stored is None:
+            return {"error": f"File size is over limit. Max size is {max_upload_bytes // 2 ** 20}MB."}
+        temp_path, size, header = stored
 
+        # libmagic identifies audio files by their first bytes
+        file_format = magic.from_buffer(header, mime=True)
         if 'audio' not in file_format:
             return {"error": "Invalid file content."}
 
-        # Make sure the resources directory exists
-        os.makedirs("resources", exist_ok=True)
+        # Drop any speaker embedding extracted from a previous upload with this label
+        se_extractor.se_cache.invalidate(audio_file_label, target_dir='processed')
 
-        # Use provided 'audio_file_label' for stored file's name.
-        # We retain the file extension to ensure appropriate processing later.
-        file_extension = file.filename.split('.')[-1]
         stored_file_name = f"{audio_file_label}.{file_extension}"
+        os.replace(temp_path, f"resources/{stored_file_name}")
+        temp_path = None
+        # Extract the speaker embedding now, so the first synthesis with this voice doesn't pay for it
+        voice = await asyncio.to_thread(voice_registry.register, audio_file_label, f"resources/{stored_file_name}",
+                                        se_state='pending')
+        se_jobs.submit(voice['hash'], extract_voice_se, voice)
 
-        with open(f"resources/{stored_file_name}", "wb") as f:
-            f.write(contents)
-
-        return {"message": f"File {file.filename} uploaded successfully with label {audio_file_label}."}
+        return {"message": f"File {file.filename} uploaded successfully with label {audio_file_label}.",
+                "se_state": "pending"}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        if temp_path is not None and os.path.exists(temp_path):
+            os.remove(temp_path)
+        await form.close()
+
+
+@app.get("/voices/{label}")
+async def voice_info(label: str):
+    """
+    Describe an uploaded voice, including the state of its speaker embedding extraction.
+
+    :param label: The label the voice was uploaded with.
+    :type label: str
+    :return: The duration and size of the reference audio, and `se_state`: 'pending', 'ready', 'failed'
+        or null when the embedding has not been extracted yet.
+    :rtype: dict
+    """
+    voice = await asyncio.to_thread(find_voice, label)
+    if voice is None:
+        raise HTTPException(status_code=404, detail="No matching voice found.")
+    return {key: voice.get(key) for key in ('label', 'duration', 'size', 'se_state', 'se_error')}
+
+
+async def synthesize_content(cache_key, text, reference_voice, accent, speed, watermark, format):
+    """Synthesize and encode the response of a /synthesize_speech/ request; returns (content, etag, audio seconds)."""
+    with admission.admit(admission.estimate(text, speed)):
+        await ensure_model(accent)
+        audio = await inference_pool.run(run_synthesis, text, reference_voice, accent, speed, watermark,
+                                         int(cache_key[:8], 16))
+        audio_seconds = len(audio) / tone_color_converter.hps.data.sampling_rate
+        with metrics.stage('encode'):
+            content = await asyncio.to_thread(encode_audio, audio, tone_color_converter.hps.data.sampling_rate,
+                                              format)
+    if response_cache is not None:
+        content, etag = await asyncio.to_thread(response_cache.put, cache_key, content)
+    else:
+        etag = content_etag(content)
+    return content, etag, audio_seconds
 
 
 @app.get("/synthesize_speech/")
@@ -215,7 +840,10 @@ async def synthesize_speech(
         voice: str,
         accent: Optional[str] = 'en-newest',
         speed: Optional[float] = 1.0,
-        watermark: Optional[str] = "@MyShell"
+        watermark: Optional[str] = "@MyShell",
+        format: Optional[str] = None,
+        accept: Optional[str] = Header(None),
+        if_none_match: Optional[str] = Header(None)
 ):
     """
     Synthesize speech from text using a specified voice and style.
@@ -230,53 +858,68 @@ async def synthesize_speech(
     :type speed: float, optional
     :param watermark: The watermark to be encoded in the voice conversion, defaults to '@MyShell'.
     :type watermark: str, optional
-    :return: The synthesized speech as a .wav file.
-    :rtype: .wav file
+    :param format: The output format (wav, flac, opus or mp3). Negotiated from the Accept header when omitted.
+    :type format: str, optional
+    :param if_none_match: The If-None-Match header; a 304 is returned when it matches the response's ETag.
+    :type if_none_match: str, optional
+    :return: The synthesized speech.
+    :rtype: audio file
     """
-    global model
-
-    if accent not in model:
-        logging.info(f'Loading {accent}...')
-        model[accent] = TTS(language=key_map[accent][1], device=device)
-        logging.info('...done.')
-
+    format = response_format(format, accept)
     start_time = time.time()
+    timings = metrics.start_request()
+    metrics.ACCENT_REQUESTS.inc(endpoint='synthesize_speech', accent=accent_label(accent))
     try:
         logging.info(f'Generating speech for {voice}')
         if watermark:
             logging.info(f'watermark: {watermark}')
 
-        # Retrieve the correct file based on the 'voice' parameter
-        # It should match the 'audio_file_label' used while uploading
-        matching_files = [file for file in os.listdir("resources") if file.startswith(voice)]
-
-        if not matching_files:
+        with metrics.stage('voice'):
+            reference_voice = await asyncio.to_thread(find_voice, voice)
+        if reference_voice is None:
             raise HTTPException(status_code=400, detail="No matching voice found.")
 
-        reference_speaker = f'resources/{matching_files[0]}'
-
-        target_se, audio_name = se_extractor.get_se(reference_speaker, tone_color_converter, target_dir='processed', vad=True)
+        # The voice is identified by its content hash, so re-uploading a label changes the key
+        cache_key = request_key(text=text, voice=reference_voice['hash'], accent=accent, speed=speed,
+                                watermark=watermark, format=format, version=tone_color_converter.version)
+        cached = None
+        if response_cache is not None:
+            with metrics.stage('cache'):
+                cached = await asyncio.to_thread(response_cache.get, cache_key)
+        audio_seconds = 0.
+        shared = False
+        if cached is not None:
+            content, etag = cached
+        else:
+            (content, etag, audio_seconds), shared = await synthesis_flight.do_async(
+                cache_key, synthesize_content, cache_key, text, reference_voice, accent, speed, watermark, format)
+            if shared:
+                # The audio was produced (and accounted for) by the request we attached to
+                audio_seconds = 0.
 
-        # Run the base speaker tts
-        src_path = f'{output_dir}/tmp.wav'
-        save_path = f'{output_dir}/output_v2_{accent}.wav'
-        model[accent].tts_to_file(text, model[accent].hps.data.spk2id[key_map[accent][0]], src_path, speed=speed)
-
-        # Run the tone color converter
-        tone_color_converter.convert(
-            audio_src_path=src_path,
-            src_se=source_se[accent],
-            tgt_se=target_se,
-            output_path=save_path,
-            message=watermark)
-
-        result = StreamingResponse(open(save_path, 'rb'), media_type="audio/wav")
+        if etag_matches(if_none_match, etag):
+            result = Response(status_code=304)
+        else:
+            result = Response(content, media_type=format_media_type(format))
+        result.headers["ETag"] = etag
+        result.headers["Vary"] = "Accept"
+        result.headers["X-Cache"] = "HIT" if cached is not None else "SHARED" if shared else "MISS"
+    except HTTPException:
+        raise
+    except AdmissionRejected as e:
+        raise admission_error(e)
+    except InferenceQueueFull as e:
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
     end_time = time.time()
     elapsed_time = end_time - start_time
 
+    if audio_seconds:
+        metrics.observe_audio('synthesize_speech', audio_seconds, elapsed_time)
+    timings['total'] = elapsed_time
+    result.headers["Server-Timing"] = metrics.server_timing(timings)
     result.headers["X-Elapsed-Time"] = str(elapsed_time)
     result.headers["X-Device-Used"] = device
 
@@ -287,3 +930,477 @@ async def synthesize_speech(
     result.headers["Access-Control-Allow-Methods"] = "POST, OPTIONS"
 
     return result
+
+
+async def stream_sentences(sentences, accent, speed, target_se, watermark):
+    """
+    Yield the converted audio of each sentence as soon as it is ready.
+
+    The next sentence is already queued on the inference pool while the current one
+    is being sent, so the client only ever waits for the first sentence. The watermark
+    is embedded across sentence boundaries, as /synthesize_speech/ embeds it in the
+    whole utterance; only the samples of a watermark block still being completed are held back.
+    """
+    def schedule(i):
+        return asyncio.ensure_future(
+            inference_pool.run(run_sentence, sentences[i], accent, speed, target_se, None))
+
+    watermarker = tone_color_converter.watermark_stream(watermark)
+    pending = schedule(0) if sentences else None
+    try:
+        for i in range(len(sentences)):
+            audio = await pending
+            pending = schedule(i + 1) if i + 1 < len(sentences) else None
+            audio = await asyncio.to_thread(run_stream_watermark, watermarker, audio)
+            if len(audio):
+                yield audio
+        audio = watermarker.close()
+        if len(audio):
+            yield audio
+    finally:
+        if pending is not None:
+            pending.cancel()
+
+
+@app.get("/synthesize_speech/stream")
+async def synthesize_speech_stream(
+        text: str,
+        voice: str,
+        accent: Optional[str] = 'en-newest',
+        speed: Optional[float] = 1.0,
+        watermark: Optional[str] = "@MyShell",
+        format: Optional[str] = None,
+        accept: Optional[str] = Header(None)
+):
+    """
+    Synthesize speech sentence by sentence and stream the audio while it is being generated.
+
+    :param text: The text to be synthesized into speech.
+    :type text: str
+    :param voice: The voice to be used for the synthesized speech.
+    :type voice: str
+    :param accent: The accent to be used for the synthesized speech, defaults to 'en-newest'.
+    :type accent: str, optional
+    :param speed: The speed of the synthesized speech, defaults to 1.0.
+    :type speed: float, optional
+    :param watermark: The watermark to be encoded in the streamed audio, defaults to '@MyShell'.
+    :type watermark: str, optional
+    :param format: 'wav' for a WAV header followed by 16-bit PCM frames, 'pcm' for raw 16-bit little-endian PCM,
+        or 'flac', 'opus' or 'mp3'. Negotiated from the Accept header when omitted.
+    :type format: str, optional
+    :return: The synthesized speech as a chunked stream.
+    :rtype: audio stream
+    """
+    format = response_format(format, accept, allowed=STREAM_FORMATS)
+
+    start_time = time.perf_counter()
+    metrics.ACCENT_REQUESTS.inc(endpoint='synthesize_speech_stream', accent=accent_label(accent))
+    reference_voice = await asyncio.to_thread(find_voice, voice)
+    if reference_voice is None:
+        raise HTTPException(status_code=400, detail="No matching voice found.")
+
+    # The admission is held until the last sentence has been sent
+    cost = admission.estimate(text, speed)
+    try:
+        admission.acquire(cost)
+    except AdmissionRejected as e:
+        raise admission_error(e)
+    try:
+        try:
+            await ensure_model(accent)
+            target_se, audio_name = await inference_pool.run(run_get_se, reference_voice)
+            sentences = await inference_pool.run(run_split_sentences, accent, text)
+        except HTTPException:
+            raise
+        except InferenceQueueFull as e:
+            raise HTTPException(status_code=503, detail=str(e))
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
+    except BaseException:
+        # Including cancellation, which is none of the exceptions above
+        admission.release(cost)
+        raise
+
+    sampling_rate = tone_color_converter.hps.data.sampling_rate
+
+    encoder = AudioStreamEncoder(format, sampling_rate)
+
+    async def body():
+        samples = 0
+        try:
+            yield encoder.start()
+            async for audio in stream_sentences(sentences, accent, speed, target_se, watermark):
+                samples += len(audio)
+                yield await asyncio.to_thread(encoder.write, audio)
+            yield encoder.close()
+        except Exception as e:
+            # Headers are already sent, all we can do is end the stream early
+            logging.error(f'Streaming synthesis failed: {e}')
+        metrics.observe_audio('synthesize_speech_stream', samples / sampling_rate, time.perf_counter() - start_time)
+
+    return AdmittedStreamingResponse(body(), cost, media_type=encoder.media_type,
+                                     headers={"X-Sample-Rate": str(encoder.rate), "X-Device-Used": device,
+                                              "Vary": "Accept"})
+
+
+async def bind_voice_session(options):
+    """
+    Resolve the voice and accent of a WebSocket session once, keeping its SE and model resident.
+
+    The model is held in the pool until ``release_voice_session``.
+    """
+    voice = options.get('voice')
+    accent = options.get('accent', 'en-newest')
+    if accent not in key_map:
+        raise ValueError(f"Unknown accent {accent}.")
+    reference_voice = await asyncio.to_thread(find_voice, voice) if voice else None
+    if reference_voice is None:
+        raise ValueError("No matching voice found.")
+    format = negotiate_format(options.get('format'), allowed=STREAM_FORMATS, default='pcm')
+    target_se, audio_name = await inference_pool.run(run_get_se, reference_voice)
+    language = accent_language(accent)
+    try:
+        await asyncio.wrap_future(model_pool.acquire(language))
+    except BaseException:
+        model_pool.release(language)
+        raise
+    return {
+        'voice': voice,
+        'accent': accent,
+        'language': language,
+        'speed': float(options.get('speed', 1.0)),
+        'watermark': options.get('watermark', "@MyShell"),
+        'format': format,
+        'target_se': target_se,
+    }
+
+
+def release_voice_session(session):
+    """Let the model of a session that was rebound or closed be evicted again."""
+    if session is not None:
+        model_pool.release(session['language'])
+
+
+async def rebind_voice_session(session, options):
+    """Bind a session to new options; the previous binding is kept if that fails."""
+    bound = await bind_voice_session(options)
+    release_voice_session(session)
+    return bound
+
+
+@app.websocket("/synthesize_speech/ws")
+async def synthesize_speech_ws(websocket: WebSocket):
+    """
+    Bidirectional TTS session.
+
+    The voice is bound once, either with `voice`/`accent`/`speed`/`watermark`/`format`
+    query parameters or with a JSON message holding those fields, and can be rebound the
+    same way at any time. Every following text message (plain text or {"text": ...}) is
+    answered with binary frames holding the audio of each sentence and a {"event": "done"}
+    message. With the default 'pcm' format every frame is 16-bit PCM; with the other
+    stream formats the frames of one message concatenate to one audio file. The server
+    replies {"event": "ready", "sample_rate": ..., "format": ...} after binding and
+    {"event": "error", "detail": ...} when a message cannot be handled.
+    """
+    await websocket.accept()
+    session = None
+    sampling_rate = tone_color_converter.hps.data.sampling_rate
+    try:
+        if 'voice' in websocket.query_params:
+            try:
+                session = await rebind_voice_session(session, dict(websocket.query_params))
+                await websocket.send_json({'event': 'ready', 'format': session['format'],
+                                           'sample_rate': encoding_rate(session['format'], sampling_rate)})
+            except Exception as e:
+                await websocket.send_json({'event': 'error', 'detail': str(e)})
+
+        while True:
+            message = await websocket.receive_text()
+            try:
+                request = json.loads(message)
+            except ValueError:
+                request = None
+            if not isinstance(request, dict):
+                request = {'text': message}
+
+            try:
+                if 'voice' in request:
+                    session = await rebind_voice_session(session, request)
+                    await websocket.send_json({'event': 'ready', 'format': session['format'],
+                                               'sample_rate': encoding_rate(session['format'], sampling_rate)})
+                if request.get('text'):
+                    if session is None:
+                        raise ValueError("No voice bound to this session.")
+                    start_time = time.perf_counter()
+                    metrics.ACCENT_REQUESTS.inc(endpoint='synthesize_speech_ws', accent=session['accent'])
+                    sentences = await inference_pool.run(run_split_sentences, session['accent'], request['text'])
+                    encoder = AudioStreamEncoder(session['format'], sampling_rate)
+                    pending = encoder.start()
+                    samples = 0
+                    with admission.admit(admission.estimate(request['text'], session['speed'])):
+                        async for audio in stream_sentences(sentences, session['accent'], session['speed'],
+                                                            session['target_se'], session['watermark']):
+                            samples += len(audio)
+                            frame = pending + await asyncio.to_thread(encoder.write, audio)
+                            pending = b''
+                            if frame:
+                                await websocket.send_bytes(frame)
+                    frame = pending + encoder.close()
+                    if frame:
+                        await websocket.send_bytes(frame)
+                    metrics.observe_audio('synthesize_speech_ws', samples / sampling_rate,
+                                          time.perf_counter() - start_time)
+                    await websocket.send_json({'event': 'done'})
+            except WebSocketDisconnect:
+                raise
+            except AdmissionRejected as e:
+                await websocket.send_json({'event': 'error', 'detail': str(e), 'retry_after': e.retry_after})
+            except Exception as e:
+                await websocket.send_json({'event': 'error', 'detail': str(e)})
+    except WebSocketDisconnect:
+        pass
+    finally:
+        release_voice_session(session)
+
+
+@app.post("/prefetch_accents/")
+async def prefetch_accents(request: PrefetchAccentsRequest):
+    """
+    Start loading accent models in the background before they are needed.
+
+    :param request: The accents the client is about to use.
+    :type request: PrefetchAccentsRequest
+    :return: The state of the accent model pool.
+    :rtype: dict
+    """
+    unknown = [accent for accent in request.accents if accent not in key_map]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown accents: {', '.join(unknown)}")
+    model_pool.prefetch(dict.fromkeys(accent_language(accent) for accent in request.accents))
+    return accent_model_stats()
+
+
+@app.get("/accent_models/")
+async def accent_models():
+    """
+    Report which language models are loaded, loading and pinned, their memory use, and the
+    language model each accent is served by.
+
+    :return: The state of the accent model pool.
+    :rtype: dict
+    """
+    return accent_model_stats()
+
+
+@app.get("/response_cache/")
+async def response_cache_stats():
+    """
+    Report the size and hit rate of the synthesized audio cache.
+
+    :return: Cache statistics, or {"enabled": false} when the cache is disabled.
+    :rtype: dict
+    """
+    if response_cache is None:
+        return {"enabled": False}
+    return dict(response_cache.stats(), enabled=True)
+
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    """
+    Export request, stage and model metrics in the Prometheus text format.
+
+    :return: The current metrics of this server process.
+    :rtype: text/plain
+    """
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/admission/")
+async def admission_state():
+    """
+    Report the estimated seconds of audio in flight, the high-water mark and the rejection count.
+
+    :return: The state of the admission controller.
+    :rtype: dict
+    """
+    return admission.stats()
+
+
+@app.get("/storage/")
+async def storage_state():
+    """
+    Report the disk usage of the primary data, caches and outputs, and what the storage sweep evicted.
+
+    :return: Size per area, free disk space and eviction counts.
+    :rtype: dict
+    """
+    return storage.stats()
+
+
+@app.post("/storage/sweep/")
+async def storage_sweep():
+    """
+    Run the storage sweep now instead of waiting for the next interval.
+
+    :return: Size per area, free disk space and eviction counts after the sweep.
+    :rtype: dict
+    """
+    return await asyncio.to_thread(storage.sweep)
+
+
+def upload_sources(directory, filenames):
+    """Audio files in the uploads saved under `directory`/<index>/, named after the uploaded files."""
+    for index, filename in enumerate(filenames):
+        prefix = os.path.join(directory, str(index), '')
+        for name, source in iter_sources([prefix + filename]):
+            yield name[len(prefix):], source
+
+
+def save_uploads(files, directory):
+    filenames = []
+    for index, file in enumerate(files):
+        filename = os.path.basename(file.filename or '') or 'upload'
+        os.makedirs(os.path.join(directory, str(index)))
+        with open(os.path.join(directory, str(index), filename), 'wb') as f:
+            shutil.copyfileobj(file.file, f, 1024 * 1024)
+        filenames.append(filename)
+    return filenames
+
+
+@app.post("/detect_watermark/")
+async def detect_watermark(files: List[UploadFile] = File(...), message: Optional[str] = Form('@MyShell')):
+    """
+    Check the watermark of many audio files.
+
+    Files are decoded by a pool of processes and their watermarks decoded in batches. The results
+    stream back as JSON lines: one per file, plus `{"stats": ...}` lines with the throughput every
+    few seconds and at the end.
+
+    :param files: Audio files, or .zip/.tar archives of audio files.
+    :type files: List[UploadFile]
+    :param message: The expected watermark message.
+    :type message: str
+    :return: A stream of JSON lines.
+    :rtype: StreamingResponse
+    """
+    directory = tempfile.mkdtemp(prefix='openvoice-audit-')
+    try:
+        filenames = await asyncio.to_thread(save_uploads, files, directory)
+    except BaseException:
+        shutil.rmtree(directory, ignore_errors=True)
+        raise
+
+    def body():
+        try:
+            for result in watermark_auditor.run(upload_sources(directory, filenames), message=message):
+                yield json.dumps(result) + '\n'
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    return StreamingResponse(body(), media_type="application/x-ndjson")
+
+
+@app.post("/jobs/")
+async def create_job(request: SynthesisJobRequest):
+    """
+    Queue a batch of texts for synthesis in the background.
+
+    Items are grouped by accent and voice, so consecutive items reuse the loaded model and
+    the cached SE of the voice.
+
+    :param request: The items to synthesize and the output format of all of them.
+    :type request: SynthesisJobRequest
+    :return: The job ID and progress.
+    :rtype: dict
+    """
+    format = response_format(request.format, None)
+    for index, item in enumerate(request.items):
+        if item.accent not in key_map:
+            raise HTTPException(status_code=400, detail=f"Item {index}: unknown accent {item.accent}.")
+        if await asyncio.to_thread(find_voice, item.voice) is None:
+            raise HTTPException(status_code=400, detail=f"Item {index}: no matching voice found.")
+    model_pool.prefetch(sorted({accent_language(item.accent) for item in request.items}))
+    job = await asyncio.to_thread(job_manager.submit, [item.model_dump() for item in request.items], format)
+    return job.summary()
+
+
+def get_job(job_id):
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found.")
+    return job
+
+
+@app.get("/jobs/{job_id}")
+async def job_status(job_id: str):
+    """
+    Report the progress of a batch job.
+
+    :param job_id: The ID returned when the job was created.
+    :type job_id: str
+    :return: The job status, item counts and timings, and the errors of failed items.
+    :rtype: dict
+    """
+    job = await asyncio.to_thread(get_job, job_id)
+    summary = job.summary()
+    if job.failed:
+        summary['errors'] = {index: job.error(index) for index in range(len(job.items))
+                             if os.path.exists(job.error_path(index))}
+    return summary
+
+
+@app.get("/jobs/{job_id}/items/{index}")
+async def job_item(job_id: str, index: int):
+    """
+    Download the audio of one item of a batch job.
+
+    :param job_id: The ID returned when the job was created.
+    :type job_id: str
+    :param index: The position of the item in the submitted list.
+    :type index: int
+    :return: The synthesized speech.
+    :rtype: audio file
+    """
+    job = await asyncio.to_thread(get_job, job_id)
+    if not 0 <= index < len(job.items):
+        raise HTTPException(status_code=404, detail="Item not found.")
+    if os.path.exists(job.result_path(index)):
+        return FileResponse(job.result_path(index), media_type=format_media_type(job.format))
+    error = job.error(index)
+    if error is not None:
+        raise HTTPException(status_code=422, detail=error)
+    raise HTTPException(status_code=404, detail="Item is not ready yet.")
+
+
+@app.get("/jobs/{job_id}/results.zip")
+async def job_results(job_id: str):
+    """
+    Download all results of a finished batch job as a zip archive.
+
+    :param job_id: The ID returned when the job was created.
+    :type job_id: str
+    :return: One file per item, named by its index; failed items have a .error file instead.
+    :rtype: .zip file
+    """
+    job = await asyncio.to_thread(get_job, job_id)
+    if job.status in ('queued', 'running'):
+        raise HTTPException(status_code=409, detail="Job is not finished yet.")
+    archive_path = await asyncio.to_thread(job_manager.archive, job)
+    return FileResponse(archive_path, media_type="application/zip", filename=f"{job.id}.zip")
+
+
+@app.delete("/jobs/{job_id}")
+async def delete_job(job_id: str):
+    """
+    Cancel a batch job and delete its results.
+
+    :param job_id: The ID returned when the job was created.
+    :type job_id: str
+    :return: The final state of the job.
+    :rtype: dict
+    """
+    job = await asyncio.to_thread(job_manager.delete, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found.")
+    return job.summary()
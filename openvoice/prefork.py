@@ -0,0 +1,103 @@
+"""
+Pre-fork serving: load the models once, then fork worker processes that share them.
+
+The parent process imports the server module (which loads the tone color converter,
+the source SEs and the preloaded accent models), waits for background loads to
+finish, binds the listening socket and forks ``workers`` children. Each child runs
+its own uvicorn server on the inherited socket and its own inference threads, with
+an intra-op thread budget of its share of the CPU cores. Model weights are
+inherited copy-on-write and never written to, so they stay shared between
+workers. Children that die are replaced.
+"""
+
+import gc
+import os
+import signal
+import socket
+import time
+import logging
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+def bind_socket(host, port, backlog=2048):
+    sock = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+def run_worker(app, lifecycle, sock, threads):
+    from openvoice.lifecycle import run_server
+
+    torch.set_num_threads(threads)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    # Each worker drains its own requests on the SIGTERM forwarded by the parent
+    run_server(app, lifecycle, sockets=[sock], log_level='info')
+
+
+def serve(host='0.0.0.0', port=8000, workers=2, threads_per_worker=None):
+    from openvoice import openvoice_server
+
+    if openvoice_server.device != 'cpu':
+        raise RuntimeError('Pre-fork serving shares CPU tensors between processes; run one process per GPU instead.')
+
+    if threads_per_worker is None:
+        threads_per_worker = max(1, (os.cpu_count() or 1) // workers)
+
+    # No background loader may be running (or holding a lock) when we fork
+    openvoice_server.model_pool.wait()
+    sock = bind_socket(host, port)
+
+    # Keep the garbage collector from touching (and so copying) the inherited heap
+    gc.collect()
+    gc.freeze()
+
+    children = {}
+    stopping = False
+
+    def spawn(slot):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                run_worker(openvoice_server.app, openvoice_server.lifecycle, sock, threads_per_worker)
+            finally:
+                os._exit(0)
+        children[pid] = slot
+        logger.info(f'Started worker {slot} (pid {pid}) with {threads_per_worker} threads')
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for slot in range(workers):
+        spawn(slot)
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        slot = children.pop(pid, None)
+        if slot is None:
+            continue
+        if not stopping:
+            logger.warning(f'Worker {slot} (pid {pid}) exited with status {status}, restarting')
+            time.sleep(1)
+            spawn(slot)
+    sock.close()
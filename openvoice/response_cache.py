@@ -0,0 +1,165 @@
+import os
+import json
+import logging
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+def request_key(**params):
+    """Deterministic key for a set of normalized request parameters."""
+    payload = json.dumps(params, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def content_etag(content):
+    """Strong ETag of a response body."""
+    return '"' + hashlib.sha256(content).hexdigest()[:32] + '"'
+
+
+def etag_matches(if_none_match, etag):
+    """Evaluate an If-None-Match header against ``etag`` (weak comparison, as RFC 9110 asks)."""
+    if not if_none_match:
+        return False
+    candidates = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in candidates or etag in [tag[2:] if tag.startswith('W/') else tag for tag in candidates]
+
+
+class ResponseCache(object):
+    """
+    Content-addressed cache of encoded responses.
+
+    Entries live in an in-memory LRU bounded by ``max_bytes``; entries evicted
+    from memory are spilled to ``spill_dir`` (bounded by ``max_disk_bytes``,
+    also LRU) and promoted back on the next hit. Each entry keeps the strong
+    ETag of its body so conditional requests can be answered without the body.
+    """
+
+    def __init__(self, max_bytes, spill_dir=None, max_disk_bytes=0):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir if max_disk_bytes else None
+        self.max_disk_bytes = max_disk_bytes
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._disk = OrderedDict()
+        self._disk_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if self.spill_dir is not None:
+            os.makedirs(self.spill_dir, exist_ok=True)
+            self._load_disk_index()
+
+    def _load_disk_index(self):
+        entries = []
+        for entry in os.scandir(self.spill_dir):
+            if entry.is_file() and not entry.name.endswith('.tmp'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name, stat.st_size))
+        for _, key, size in sorted(entries):
+            self._disk[key] = size
+            self._disk_bytes += size
+
+    def _disk_path(self, key):
+        return os.path.join(self.spill_dir, key)
+
+    def get(self, key):
+        """Return (content, etag) for ``key`` or None."""
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return entry
+            on_disk = key in self._disk
+
+        if on_disk:
+            try:
+                with open(self._disk_path(key), 'rb') as f:
+                    content = f.read()
+            except FileNotFoundError:
+                with self._lock:
+                    self._disk_bytes -= self._disk.pop(key, 0)
+            else:
+                with self._lock:
+                    self.disk_hits += 1
+                return self.put(key, content)
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, content):
+        """Store ``content`` under ``key`` and return (content, etag)."""
+        entry = (content, content_etag(content))
+        spilled = []
+        with self._lock:
+            if key in self._memory:
+                self._memory_bytes -= len(self._memory.pop(key)[0])
+            if len(content) <= self.max_bytes:
+                self._memory[key] = entry
+                self._memory_bytes += len(content)
+            while self._memory_bytes > self.max_bytes:
+                old_key, (old_content, _) = self._memory.popitem(last=False)
+                self._memory_bytes -= len(old_content)
+                spilled.append((old_key, old_content))
+            if len(content) > self.max_bytes:
+                spilled.append((key, content))
+        for old_key, old_content in spilled:
+            self._spill(old_key, old_content)
+        return entry
+
+    def _spill(self, key, content):
+        if self.spill_dir is None or len(content) > self.max_disk_bytes:
+            return
+        with self._lock:
+            if key in self._disk:
+                self._disk.move_to_end(key)
+                return
+        # The spill is best effort: on a full or failing disk the entry is just dropped
+        tmp_path = None
+        try:
+            # Unique per writer, as several processes may share the spill directory
+            fd, tmp_path = tempfile.mkstemp(dir=self.spill_dir, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(content)
+            os.replace(tmp_path, self._disk_path(key))
+        except OSError as e:
+            logger.warning(f'Dropping response cache entry {key}, could not spill it to disk: {e}')
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+
+        removed = []
+        with self._lock:
+            self._disk[key] = len(content)
+            self._disk_bytes += len(content)
+            while self._disk_bytes > self.max_disk_bytes:
+                old_key, size = self._disk.popitem(last=False)
+                self._disk_bytes -= size
+                removed.append(old_key)
+        for old_key in removed:
+            try:
+                os.remove(self._disk_path(old_key))
+            except OSError:
+                pass
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                'entries': len(self._memory),
+                'bytes': self._memory_bytes,
+                'max_bytes': self.max_bytes,
+                'disk_entries': len(self._disk),
+                'disk_bytes': self._disk_bytes,
+                'max_disk_bytes': self.max_disk_bytes,
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': (self.hits + self.disk_hits) / lookups if lookups else 0.,
+            }
@@ -0,0 +1,151 @@
+import os
+import re
+import glob
+import time
+import shutil
+import logging
+import threading
+from collections import OrderedDict
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+class SECache(object):
+    """
+    Two-tier cache of target speaker embeddings.
+
+    The first tier is an in-process LRU of device-resident tensors keyed by
+    (audio content hash, converter version) and bounded by ``max_bytes``.
+    The second tier is the ``<target_dir>/<audio_name>/se.pth`` files written
+    by ``ToneColorConverter.extract_se``.
+
+    Every hit marks ``se_path`` as used (at most every ``touch_interval``
+    seconds), so the storage sweep of any process sharing the directory sees
+    which embeddings are in use.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, touch_interval=60.):
+        self.max_bytes = max_bytes
+        self.touch_interval = touch_interval
+        self._entries = OrderedDict()
+        self._touched = {}
+        self._labels = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _nbytes(se):
+        return se.numel() * se.element_size()
+
+    def get(self, key, se_path=None, device='cpu', label=None, audio_name=None):
+        """
+        Return the cached embedding for ``key``, falling back to ``se_path`` on disk.
+
+        Embeddings found on disk are promoted into the memory tier. Returns None on a miss.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                touch = se_path is not None and time.monotonic() - self._touched.get(key, 0.) > self.touch_interval
+                if touch:
+                    self._touched[key] = time.monotonic()
+        if entry is not None:
+            if touch:
+                self._touch(se_path)
+            return entry[0]
+
+        if se_path is not None and os.path.isfile(se_path):
+            try:
+                se = torch.load(se_path, map_location=device)
+            except Exception as e:
+                logger.warning(f'Ignoring unreadable speaker embedding {se_path}: {e}')
+            else:
+                self._touch(se_path)
+                with self._lock:
+                    self.disk_hits += 1
+                    self._touched[key] = time.monotonic()
+                return self.put(key, se, label, audio_name)
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    @staticmethod
+    def _touch(se_path):
+        try:
+            # Marks the file as recently used for the storage sweep
+            os.utime(se_path)
+        except OSError:
+            pass
+
+    def put(self, key, se, label=None, audio_name=None):
+        nbytes = self._nbytes(se)
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= self._nbytes(self._entries.pop(key)[0])
+            if nbytes > self.max_bytes:
+                return se
+            self._entries[key] = (se, label)
+            self._bytes += nbytes
+            if label is not None and audio_name is not None:
+                self._labels.setdefault(label, set()).add(audio_name)
+            while self._bytes > self.max_bytes:
+                old_key, (old, _) = self._entries.popitem(last=False)
+                self._touched.pop(old_key, None)
+                self._bytes -= self._nbytes(old)
+                self.evictions += 1
+        return se
+
+    def invalidate(self, label, target_dir='processed'):
+        """
+        Drop every embedding derived from the voice ``label`` from memory and disk.
+
+        Called when a label is re-uploaded so the next request re-extracts the
+        embedding from the new reference audio.
+        """
+        with self._lock:
+            for key in [k for k, (_, l) in self._entries.items() if l == label]:
+                self._bytes -= self._nbytes(self._entries.pop(key)[0])
+                self._touched.pop(key, None)
+            audio_names = self._labels.pop(label, set())
+
+        # Also catch entries written by previous processes: <label>_<version>_<hash>
+        pattern = re.compile(re.escape(label) + r'_[^_]+_(?:[A-Za-z0-9+=]|_\^)+')
+        for path in glob.glob(os.path.join(glob.escape(target_dir), glob.escape(label) + '_*')):
+            if pattern.fullmatch(os.path.basename(path)):
+                audio_names.add(os.path.basename(path))
+
+        for audio_name in audio_names:
+            shutil.rmtree(os.path.join(target_dir, audio_name), ignore_errors=True)
+
+    def keys(self):
+        """The (audio hash, version) keys held in memory."""
+        with self._lock:
+            return list(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._touched.clear()
+            self._labels.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
@@ -1,19 +1,22 @@
 import os
 import glob
+import shutil
 import torch
-import hashlib
-import librosa
-import base64
 from glob import glob
 import numpy as np
 from pydub import AudioSegment
 from faster_whisper import WhisperModel
-import hashlib
-import base64
-import librosa
+import threading
+from contextlib import nullcontext
 from whisper_timestamped.transcribe import get_audio_tensor, get_vad_segments
+from openvoice.se_cache import SECache
+from openvoice.utils import hash_file
 
 model_size = "medium"
+# In-process cache of target speaker embeddings, backed by <target_dir>/<audio_name>/se.pth
+se_cache = SECache()
+# The silero VAD model keeps internal state between calls, so it must not run concurrently
+vad_lock = threading.Lock()
 # Run on GPU with FP16
 model = None
 def split_audio_whisper(audio_path, audio_name, target_dir='processed'):
@@ -74,16 +77,25 @@ def split_audio_whisper(audio_path, audio_name, target_dir='processed'):
     return wavs_folder
 
 
+def warmup_vad():
+    """Load the silero VAD model (downloading it on first use) and run it once on a second of noise."""
+    noise = torch.from_numpy(np.random.default_rng(0).uniform(-0.01, 0.01, 16000).astype(np.float32))
+    with vad_lock:
+        get_vad_segments(noise, output_sample=True, min_speech_duration=0.1, min_silence_duration=1,
+                         method="silero")
+
+
 def split_audio_vad(audio_path, audio_name, target_dir, split_seconds=10.0):
     SAMPLE_RATE = 16000
     audio_vad = get_audio_tensor(audio_path)
-    segments = get_vad_segments(
-        audio_vad,
-        output_sample=True,
-        min_speech_duration=0.1,
-        min_silence_duration=1,
-        method="silero",
-    )
+    with vad_lock:
+        segments = get_vad_segments(
+            audio_vad,
+            output_sample=True,
+            min_speech_duration=0.1,
+            min_silence_duration=1,
+            method="silero",
+        )
     segments = [(seg["start"], seg["end"]) for seg in segments]
     segments = [(float(s) / SAMPLE_RATE, float(e) / SAMPLE_RATE) for s,e in segments]
     print(segments)
@@ -115,31 +127,24 @@ def split_audio_vad(audio_path, audio_name, target_dir, split_seconds=10.0):
         count += 1
     return wavs_folder
 
-def hash_numpy_array(audio_path):
-    array, _ = librosa.load(audio_path, sr=None, mono=True)
-    # Convert the array to bytes
-    array_bytes = array.tobytes()
-    # Calculate the hash of the array bytes
-    hash_object = hashlib.sha256(array_bytes)
-    hash_value = hash_object.digest()
-    # Convert the hash value to base64
-    base64_value = base64.b64encode(hash_value)
-    return base64_value.decode('utf-8')[:16].replace('/', '_^')
-
-def get_se(audio_path, vc_model, target_dir='processed', vad=True):
+def get_se(audio_path, vc_model, target_dir='processed', vad=True, cache=None, lock=None, audio_hash=None,
+           keep_segments=True):
     device = vc_model.device
     version = vc_model.version
-    print("OpenVoice version:", version)
+    if cache is None:
+        cache = se_cache
 
-    audio_name = f"{os.path.basename(audio_path).rsplit('.', 1)[0]}_{version}_{hash_numpy_array(audio_path)}"
+    label = os.path.basename(audio_path).rsplit('.', 1)[0]
+    if audio_hash is None:
+        audio_hash = hash_file(audio_path)
+    audio_name = f"{label}_{version}_{audio_hash}"
     se_path = os.path.join(target_dir, audio_name, 'se.pth')
 
-    # if os.path.isfile(se_path):
-    #     se = torch.load(se_path).to(device)
-    #     return se, audio_name
-    # if os.path.isdir(audio_path):
-    #     wavs_folder = audio_path
-    
+    se = cache.get((audio_hash, version), se_path, device=device, label=label, audio_name=audio_name)
+    if se is not None:
+        return se, audio_name
+    print("OpenVoice version:", version)
+
     if vad:
         wavs_folder = split_audio_vad(audio_path, target_dir=target_dir, audio_name=audio_name)
     else:
@@ -149,5 +154,10 @@ def get_se(audio_path, vc_model, target_dir='processed', vad=True):
     if len(audio_segs) == 0:
         raise NotImplementedError('No audio segments found!')
     
-    return vc_model.extract_se(audio_segs, se_save_path=se_path), audio_name
-
+    # `lock` guards vc_model when it is shared between inference threads
+    with lock or nullcontext():
+        se = vc_model.extract_se(audio_segs, se_save_path=se_path)
+    if not keep_segments:
+        # Only se.pth is read back, the segments can be regenerated from the reference audio
+        shutil.rmtree(wavs_folder, ignore_errors=True)
+    return cache.put((audio_hash, version), se, label, audio_name), audio_name
@@ -0,0 +1,49 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class SEExtractionQueue(object):
+    """
+    Extracts the speaker embeddings of uploaded voices in the background.
+
+    There is at most one extraction per key (the hash of the reference audio):
+    ``submit`` returns the job already queued or running for the same audio, and
+    requests that need the embedding meanwhile wait on that job (``get``) instead
+    of extracting it a second time. Jobs are forgotten once they finish, by then
+    the embedding is in the SE cache.
+    """
+
+    def __init__(self, workers=1):
+        self.workers = workers
+        self._start()
+        # Worker threads do not survive fork(), pre-forked server processes need their own
+        os.register_at_fork(after_in_child=self._start)
+
+    def _start(self):
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='se-extraction')
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, key, fn, *args):
+        with self._lock:
+            future = self._jobs.get(key)
+            if future is not None:
+                return future
+            future = self._jobs[key] = self._executor.submit(fn, *args)
+        # Outside the lock: a job that already finished runs the callback right here
+        future.add_done_callback(lambda _: self._forget(key, future))
+        return future
+
+    def _forget(self, key, future):
+        with self._lock:
+            if self._jobs.get(key) is future:
+                del self._jobs[key]
+
+    def get(self, key):
+        with self._lock:
+            return self._jobs.get(key)
+
+    @property
+    def pending(self):
+        return len(self._jobs)
@@ -0,0 +1,61 @@
+import asyncio
+import threading
+from concurrent.futures import Future
+
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent calls that share a key into a single execution.
+
+    The first caller for a key runs the function; callers arriving while it is
+    still running wait for it and get the same result (or exception). Nothing is
+    remembered once the call has finished, caching is left to the caller.
+    ``do`` is for threads, ``do_async`` for coroutines on the event loop. Both
+    return ``(result, shared)``, with ``shared`` True for the callers that
+    attached to another call.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.shared = 0
+        self._futures = {}
+        self._tasks = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, *args):
+        with self._lock:
+            future = self._futures.get(key)
+            leader = future is None
+            if leader:
+                future = self._futures[key] = Future()
+                self.calls += 1
+            else:
+                self.shared += 1
+        if not leader:
+            return future.result(), True
+        try:
+            result = fn(*args)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            with self._lock:
+                del self._futures[key]
+
+    async def do_async(self, key, fn, *args):
+        task = self._tasks.get(key)
+        shared = task is not None
+        if shared:
+            self.shared += 1
+        else:
+            task = self._tasks[key] = asyncio.ensure_future(fn(*args))
+            task.add_done_callback(lambda _: self._tasks.pop(key, None))
+            self.calls += 1
+        # A caller that goes away must not cancel the call the others are waiting for
+        return await asyncio.shield(task), shared
+
+    def stats(self):
+        return {'in_flight': len(self._futures) + len(self._tasks), 'calls': self.calls, 'shared': self.shared}
@@ -0,0 +1,235 @@
+import os
+import re
+import time
+import fcntl
+import shutil
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# <label>_<version>_<hash>, where '/' in the base64 hash is written as '_^'
+_AUDIO_HASH = re.compile(r'_((?:[A-Za-z0-9+=]|_\^)+)$')
+
+
+def tree_size(path):
+    """Total size in bytes and number of files below ``path``."""
+    size = files = 0
+    stack = [path]
+    while stack:
+        try:
+            entries = list(os.scandir(stack.pop()))
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                else:
+                    size += entry.stat(follow_symlinks=False).st_size
+                    files += 1
+            except FileNotFoundError:
+                pass
+    return size, files
+
+
+def audio_hash(audio_name):
+    """The reference audio hash at the end of a ``processed/`` directory name, or None."""
+    match = _AUDIO_HASH.search(audio_name)
+    return match.group(1) if match else None
+
+
+class StorageManager(object):
+    """
+    Keeps the regenerable artifacts on disk within size and age budgets.
+
+    Primary data, the reference audio in ``resources_dir``, is only measured.
+    Derived data is evicted on every ``sweep``:
+
+    - ``processed_dir/<audio_name>/``, the VAD segments and cached SE of a voice.
+      Directories of voices whose audio is gone (``live_hashes``, the content
+      hashes of the reference audio files on disk) and extractions
+      abandoned for longer than ``extraction_grace`` go first, then those unused
+      for ``processed_ttl`` seconds, then the least recently used ones until they
+      fit in ``max_processed_bytes`` and the disk has ``min_free_bytes`` free.
+      Voices whose SE is held in memory (``in_use``) are kept. ``on_evict`` is
+      called once per sweep with the names of the directories removed.
+    - finished batch jobs older than ``job_ttl`` seconds, through ``jobs.expire``.
+    - upload temp files left behind in ``resources_dir`` by a crash.
+
+    A budget or TTL of 0 disables it. When several processes share the
+    directories only one of them evicts at a time, the others just measure.
+    """
+
+    def __init__(self, processed_dir='processed', resources_dir='resources', outputs_dir='outputs', jobs=None,
+                 max_processed_bytes=0, processed_ttl=0., job_ttl=0., min_free_bytes=0, live_hashes=None,
+                 in_use=None, on_evict=None, extraction_grace=600., upload_ttl=3600.):
+        self.processed_dir = processed_dir
+        self.resources_dir = resources_dir
+        self.outputs_dir = outputs_dir
+        self.jobs = jobs
+        self.max_processed_bytes = max_processed_bytes
+        self.processed_ttl = processed_ttl
+        self.job_ttl = job_ttl
+        self.min_free_bytes = min_free_bytes
+        self.live_hashes = live_hashes
+        self.in_use = in_use
+        self.on_evict = on_evict
+        self.extraction_grace = extraction_grace
+        self.upload_ttl = upload_ttl
+        self.evicted = {}
+        self.freed_bytes = 0
+        self.sweeps = 0
+        self.last_sweep = None
+        self.sweep_seconds = None
+        self._areas = {}
+        self._interval = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        for path in (processed_dir, resources_dir, outputs_dir):
+            os.makedirs(path, exist_ok=True)
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+        if self._interval is not None:
+            self.start(self._interval)
+
+    def start(self, interval):
+        """Sweep now and then every ``interval`` seconds on a background thread."""
+        self._interval = interval
+        def loop():
+            while True:
+                try:
+                    self.sweep()
+                except Exception as e:
+                    logger.warning(f'Storage sweep failed: {e}')
+                if self._stop.wait(interval):
+                    return
+
+        threading.Thread(target=loop, name='storage-gc', daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+
+    def sweep(self):
+        """Evict what is over budget, measure every area and return the stats."""
+        with self._lock:
+            start = time.monotonic()
+            with open(os.path.join(self.outputs_dir, '.storage.lock'), 'w') as lock_file:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    # Another process is evicting the same directories
+                    pass
+                else:
+                    self._evict_processed()
+                    if self.jobs is not None and self.job_ttl > 0:
+                        self._count('expired_job', self.jobs.expire(self.job_ttl))
+                    self._remove_stale_uploads()
+            self._areas = self._measure()
+            self.sweeps += 1
+            self.last_sweep = time.time()
+            self.sweep_seconds = time.monotonic() - start
+        return self.stats()
+
+    def _count(self, reason, count=1):
+        if count:
+            self.evicted[reason] = self.evicted.get(reason, 0) + count
+
+    def _free_bytes(self):
+        return shutil.disk_usage(self.processed_dir).free
+
+    def _evict_processed(self):
+        now = time.time()
+        live = self.live_hashes() if self.live_hashes is not None else None
+        in_use = self.in_use() if self.in_use is not None else set()
+        entries = []
+        for entry in os.scandir(self.processed_dir):
+            if not entry.is_dir() or entry.name.startswith('.'):
+                continue
+            try:
+                # The SE cache touches se.pth whenever it loads it, so its mtime is the last use
+                last_used, complete = os.stat(os.path.join(entry.path, 'se.pth')).st_mtime, True
+            except FileNotFoundError:
+                last_used, complete = entry.stat().st_mtime, False
+            except OSError:
+                continue
+            entries.append((last_used, complete, entry.name, tree_size(entry.path)[0]))
+
+        total = sum(size for _, _, _, size in entries)
+        kept = []
+        removed = []
+        freed = 0
+        for last_used, complete, name, size in sorted(entries):
+            settled = now - last_used > self.extraction_grace
+            if not settled or audio_hash(name) in in_use:
+                reason = None
+            elif not complete:
+                reason = 'abandoned_extraction'
+            elif live is not None and audio_hash(name) not in live:
+                reason = 'orphaned'
+            elif self.processed_ttl > 0 and now - last_used > self.processed_ttl:
+                reason = 'expired'
+            else:
+                reason = None
+                kept.append((name, size))
+            if reason is not None:
+                freed += self._remove_processed(name, size, reason)
+                removed.append(name)
+
+        # Least recently used first, until both the size budget and the free space are met
+        for name, size in kept:
+            over_budget = self.max_processed_bytes > 0 and total - freed > self.max_processed_bytes
+            low_on_disk = self.min_free_bytes > 0 and self._free_bytes() < self.min_free_bytes
+            if not over_budget and not low_on_disk:
+                break
+            freed += self._remove_processed(name, size, 'over_budget' if over_budget else 'low_disk')
+            removed.append(name)
+        if removed and self.on_evict is not None:
+            self.on_evict(removed)
+        if freed:
+            logger.info(f'Storage sweep freed {freed / 1024 / 1024:.1f} MB in {self.processed_dir}/')
+
+    def _remove_processed(self, name, size, reason):
+        shutil.rmtree(os.path.join(self.processed_dir, name), ignore_errors=True)
+        self._count(reason)
+        self.freed_bytes += size
+        return size
+
+    def _remove_stale_uploads(self):
+        cutoff = time.time() - self.upload_ttl
+        for entry in os.scandir(self.resources_dir):
+            try:
+                if entry.name.startswith('.upload-') and entry.stat().st_mtime < cutoff:
+                    size = entry.stat().st_size
+                    os.remove(entry.path)
+                    self._count('stale_upload')
+                    self.freed_bytes += size
+            except FileNotFoundError:
+                pass
+
+    def _measure(self):
+        areas = {}
+        for area, path, kind in (('resources', self.resources_dir, 'primary'),
+                                 ('processed', self.processed_dir, 'cache'),
+                                 ('jobs', os.path.join(self.outputs_dir, 'jobs'), 'output'),
+                                 ('response_cache', os.path.join(self.outputs_dir, 'response_cache'), 'cache')):
+            size, files = tree_size(path)
+            areas[area] = {'path': path, 'kind': kind, 'bytes': size, 'files': files}
+        areas['processed'].update(max_bytes=self.max_processed_bytes, ttl_seconds=self.processed_ttl)
+        areas['jobs'].update(ttl_seconds=self.job_ttl)
+        return areas
+
+    def stats(self):
+        usage = shutil.disk_usage(self.processed_dir)
+        return {
+            'areas': self._areas,
+            'disk': {'total_bytes': usage.total, 'used_bytes': usage.used, 'free_bytes': usage.free,
+                     'min_free_bytes': self.min_free_bytes},
+            'evicted': dict(self.evicted),
+            'freed_bytes': self.freed_bytes,
+            'sweeps': self.sweeps,
+            'last_sweep': self.last_sweep,
+            'sweep_seconds': self.sweep_seconds,
+        }
@@ -1,5 +1,7 @@
 import re
 import json
+import base64
+import hashlib
 import numpy as np
 
 
@@ -43,6 +45,17 @@ class HParams:
         return self.__dict__.__repr__()
 
 
+def hash_file(path, chunk_size=1024 * 1024):
+    # Hash the encoded file contents rather than the decoded samples, so a
+    # cache lookup does not have to decode the reference audio.
+    hash_object = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            hash_object.update(chunk)
+    base64_value = base64.b64encode(hash_object.digest())
+    return base64_value.decode('utf-8')[:16].replace('/', '_^')
+
+
 def string_to_bits(string, pad_len=8):
     # Convert each character to its ASCII value
     ascii_values = [ord(char) for char in string]
@@ -0,0 +1,279 @@
+import os
+import json
+import time
+import fcntl
+import logging
+import tempfile
+import threading
+
+import soundfile
+
+from openvoice.utils import hash_file
+
+logger = logging.getLogger(__name__)
+
+AUDIO_EXTENSIONS = {'wav', 'mp3', 'flac', 'ogg'}
+
+
+class VoiceRegistry(object):
+    """
+    Exact label -> voice index over the reference audio directory.
+
+    Each entry records the file path, content hash, duration, size/mtime (to spot
+    files changed behind our back), the state of its speaker embedding extraction
+    (None, 'pending', 'ready' or 'failed') and, once known, the path of the cached
+    speaker embedding. The index is persisted to a small JSON manifest inside the directory
+    so that restarts only need to stat files, not re-hash them.
+
+    The index in memory is authoritative. Changes are written to the manifest by a
+    background thread, at most every ``flush_delay`` seconds, so lookups never wait
+    for the disk. Entries are replaced, never modified in place, so a shallow copy of
+    the index is a consistent snapshot to write.
+    """
+
+    def __init__(self, root='resources', manifest_name='.voices.json', flush_delay=1.):
+        self.root = root
+        self.manifest_path = os.path.join(root, manifest_name)
+        self.flush_delay = flush_delay
+        self._voices = {}
+        self._lock = threading.RLock()
+        self._watcher = None
+        self._watch_interval = None
+        self._stop = threading.Event()
+        # Changes to the index, and the last one written to the manifest
+        self._version = 0
+        self._saved_version = 0
+        self._changed = threading.Event()
+        self._flusher = None
+        self._flush_lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+        self._load()
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        self._lock = threading.RLock()
+        self._flush_lock = threading.Lock()
+        self._changed = threading.Event()
+        self._flusher = None
+        if self._version != self._saved_version:
+            self._save()
+        if self._watch_interval is not None:
+            self.watch(self._watch_interval)
+
+    def _load(self):
+        try:
+            with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                self._voices = json.load(f)
+        except FileNotFoundError:
+            self._voices = {}
+        except ValueError as e:
+            logger.warning(f'Ignoring corrupt voice manifest {self.manifest_path}: {e}')
+            self._voices = {}
+
+    def _save(self):
+        """Record a change to the index and wake the flusher; called with the lock held."""
+        self._version += 1
+        if self._flusher is None:
+            self._flusher = threading.Thread(target=self._flush_loop, name='voice-registry-flush', daemon=True)
+            self._flusher.start()
+        self._changed.set()
+
+    def _flush_loop(self):
+        while True:
+            self._changed.wait()
+            # Write the changes of a burst of uploads at once
+            time.sleep(self.flush_delay)
+            self._changed.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.warning(f'Could not write voice manifest {self.manifest_path}: {e}')
+                self._changed.set()
+
+    def flush(self):
+        """Write the manifest now if the index changed since it was last written."""
+        with self._flush_lock:
+            with self._lock:
+                if self._version == self._saved_version:
+                    return
+                version, snapshot = self._version, dict(self._voices)
+            data = json.dumps(snapshot)
+            # Pre-forked server processes share the manifest: each writes its own temp file
+            # and they replace the manifest one at a time
+            fd, tmp_path = tempfile.mkstemp(dir=self.root, prefix=os.path.basename(self.manifest_path) + '.')
+            try:
+                # mkstemp creates the file private, keep the manifest readable as before
+                os.fchmod(fd, 0o644)
+                with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                    f.write(data)
+                with open(self.manifest_path + '.lock', 'w') as lock_file:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                    os.replace(tmp_path, self.manifest_path)
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+            self._saved_version = version
+
+    @staticmethod
+    def _describe(path):
+        stat = os.stat(path)
+        try:
+            duration = soundfile.info(path).duration
+        except Exception:
+            duration = None
+        return {
+            'path': path,
+            'hash': hash_file(path),
+            'duration': duration,
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'se_path': None,
+            'se_state': None,
+            'se_error': None,
+        }
+
+    def get(self, label):
+        """Return the entry for ``label`` or None; a copy, so callers cannot corrupt the index."""
+        with self._lock:
+            entry = self._voices.get(label)
+            return dict(entry, label=label) if entry is not None else None
+
+    def lookup(self, label):
+        """
+        Like ``get``, but validates the entry against the file with a single stat.
+
+        Picks up voices registered or replaced by other server processes sharing the
+        directory, without a full rescan.
+        """
+        if os.path.basename(label) != label or label.startswith('.'):
+            return None
+        entry = self.get(label)
+        if entry is not None:
+            try:
+                stat = os.stat(entry['path'])
+                if stat.st_size == entry['size'] and stat.st_mtime == entry['mtime']:
+                    return entry
+            except FileNotFoundError:
+                pass
+        for extension in AUDIO_EXTENSIONS:
+            path = os.path.join(self.root, f'{label}.{extension}')
+            if os.path.isfile(path):
+                entry = self._describe(path)
+                with self._lock:
+                    self._voices[label] = entry
+                    self._save()
+                return dict(entry, label=label)
+        if entry is not None:
+            self.remove(label)
+        return None
+
+    def __contains__(self, label):
+        return label in self._voices
+
+    def __len__(self):
+        return len(self._voices)
+
+    def labels(self):
+        with self._lock:
+            return list(self._voices)
+
+    def hashes(self):
+        """The content hashes of all indexed voices."""
+        with self._lock:
+            return {entry['hash'] for entry in self._voices.values()}
+
+    def register(self, label, path, **fields):
+        """Index ``path`` under ``label``, replacing any previous file for that label, with ``fields`` set."""
+        entry = self._describe(path)
+        entry.update(fields)
+        with self._lock:
+            previous = self._voices.get(label)
+            self._voices[label] = entry
+            self._save()
+        if previous is not None and previous['path'] != path and os.path.isfile(previous['path']):
+            os.remove(previous['path'])
+        return dict(entry, label=label)
+
+    def update(self, label, audio_hash=None, **fields):
+        """Update the fields of ``label``'s entry, only if it still holds the audio ``audio_hash`` when given."""
+        with self._lock:
+            entry = self._voices.get(label)
+            if entry is None or (audio_hash is not None and entry['hash'] != audio_hash):
+                return
+            if all(entry.get(k) == v for k, v in fields.items()):
+                return
+            self._voices[label] = dict(entry, **fields)
+            self._save()
+
+    def clear_se(self, se_paths):
+        """Reset the SE state of the voices whose cached SE was one of ``se_paths``, with a single write."""
+        se_paths = set(se_paths)
+        with self._lock:
+            cleared = [label for label, entry in self._voices.items() if entry.get('se_path') in se_paths]
+            for label in cleared:
+                self._voices[label] = dict(self._voices[label], se_state=None, se_path=None)
+            if cleared:
+                self._save()
+
+    def remove(self, label):
+        with self._lock:
+            if self._voices.pop(label, None) is not None:
+                self._save()
+
+    def refresh(self):
+        """Re-scan the directory: index new files, re-hash changed ones and drop missing ones."""
+        found = {}
+        for entry in os.scandir(self.root):
+            name = entry.name
+            if name.startswith('.') or not entry.is_file():
+                continue
+            label, _, extension = name.rpartition('.')
+            if not label or extension.lower() not in AUDIO_EXTENSIONS:
+                continue
+            # With several files per label keep the most recently written one
+            if label not in found or entry.stat().st_mtime > os.stat(found[label]).st_mtime:
+                found[label] = entry.path
+
+        with self._lock:
+            snapshot = dict(self._voices)
+        updates = {}
+        for label, path in found.items():
+            current = snapshot.get(label)
+            try:
+                stat = os.stat(path)
+                if current is not None and current['path'] == path and current['size'] == stat.st_size \
+                        and current['mtime'] == stat.st_mtime:
+                    continue
+                # Hash outside the lock, lookups keep being served meanwhile
+                updates[label] = self._describe(path)
+            except FileNotFoundError:
+                # Replaced by an upload while we were scanning
+                continue
+        removed = [label for label in snapshot if label not in found]
+
+        if not updates and not removed:
+            return False
+        with self._lock:
+            for label in removed:
+                self._voices.pop(label, None)
+            self._voices.update(updates)
+            self._save()
+        return True
+
+    def watch(self, interval):
+        """Refresh the index every ``interval`` seconds on a background thread."""
+        self._watch_interval = interval
+        def loop():
+            while not self._stop.wait(interval):
+                try:
+                    self.refresh()
+                except Exception as e:
+                    logger.warning(f'Voice registry refresh failed: {e}')
+
+        self._watcher = threading.Thread(target=loop, name='voice-registry-watch', daemon=True)
+        self._watcher.start()
+
+    def stop(self):
+        self._stop.set()
+        self.flush()
@@ -0,0 +1,218 @@
+"""
+Bulk verification of the watermark in synthesized audio.
+
+Usage: python -m openvoice.watermark_audit [--message @MyShell] PATH [PATH ...]
+
+Paths are audio files, directories (searched recursively) or .zip/.tar archives.
+Files are decoded by a pool of processes, which only read the start of each
+file that holds the watermark. The watermarks are then decoded in batches by
+the watermark model of a single converter. One JSON line is written per file,
+plus periodic and final lines with throughput statistics.
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import tarfile
+import zipfile
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import librosa
+
+from openvoice import utils
+
+AUDIO_EXTENSIONS = {'wav', 'mp3', 'flac', 'ogg', 'opus'}
+
+# Watermark chunks are K samples long, one every coeff * K samples (see ToneColorConverter.add_watermark)
+K = 16000
+coeff = 2
+
+
+def is_audio(name):
+    return name.rpartition('.')[2].lower() in AUDIO_EXTENSIONS
+
+
+def iter_sources(paths):
+    """
+    Yield ``(name, source)`` for every audio file in ``paths``.
+
+    Plain files and zip members are read by the decoding processes themselves.
+    Tar members are read here, in one sequential pass over the archive.
+    """
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    if is_audio(name):
+                        yield os.path.join(root, name), ('file', os.path.join(root, name))
+        elif not is_audio(path) and zipfile.is_zipfile(path):
+            with zipfile.ZipFile(path) as archive:
+                for info in archive.infolist():
+                    if not info.is_dir() and is_audio(info.filename):
+                        yield f'{path}:{info.filename}', ('zip', path, info.filename)
+        elif not is_audio(path) and tarfile.is_tarfile(path):
+            with tarfile.open(path, 'r|*') as archive:
+                for member in archive:
+                    if member.isfile() and is_audio(member.name):
+                        yield f'{path}:{member.name}', ('bytes', archive.extractfile(member).read())
+        else:
+            yield path, ('file', path)
+
+
+# Zip archives opened by this (decoding) process
+_archives = {}
+
+
+def _open_source(source):
+    if source[0] == 'file':
+        return source[1]
+    if source[0] == 'bytes':
+        return io.BytesIO(source[1])
+    archive = _archives.get(source[1])
+    if archive is None:
+        archive = _archives[source[1]] = zipfile.ZipFile(source[1])
+    return io.BytesIO(archive.read(source[2]))
+
+
+def decode_source(name, source, sampling_rate, num_samples):
+    """Decode the first ``num_samples`` samples of ``source`` at ``sampling_rate``; runs in the pool processes."""
+    try:
+        # Read a little more than needed, so resampling does not distort the end of the window
+        audio, _ = librosa.load(_open_source(source), sr=sampling_rate,
+                                duration=num_samples / sampling_rate + 0.5)
+    except Exception as e:
+        return name, None, f'{type(e).__name__}: {e}'
+    return name, audio[:num_samples], None
+
+
+class WatermarkAuditor(object):
+    """
+    Checks the watermark of many audio files.
+
+    ``processes`` worker processes decode the files, keeping a few files per
+    process in flight. The decoded windows are checked ``batch_size`` files at
+    a time with ``ToneColorConverter.detect_watermarks``. The pool is started on
+    first use and reused by later runs.
+    """
+
+    def __init__(self, converter, processes=None, batch_size=64, progress_interval=10.):
+        self.converter = converter
+        self.processes = processes or os.cpu_count() or 1
+        self.batch_size = batch_size
+        self.progress_interval = progress_interval
+        self._executor = None
+        # The pool's processes belong to the process that started it
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._executor = None
+
+    def _pool(self):
+        if self._executor is None:
+            # Not fork(): the caller may be running torch threads that must not be copied mid-operation
+            self._executor = ProcessPoolExecutor(self.processes, mp_context=multiprocessing.get_context('spawn'))
+        return self._executor
+
+    def run(self, sources, message='@MyShell'):
+        """
+        Check every ``(name, source)`` of ``sources`` (see ``iter_sources``) for the watermark ``message``
+        and yield one dict per file.
+
+        Every ``progress_interval`` seconds, and once at the end, a ``{"stats": ...}`` dict is yielded as well.
+        """
+        start = time.perf_counter()
+        last_progress = start
+        stats = {'files': 0, 'watermarked': 0, 'unmarked': 0, 'errors': 0}
+        bits = utils.string_to_bits(message)
+        n_repeat = bits.size // 32
+        # What the detector reads back from a watermark of `message`, padding included
+        expected = utils.bits_to_string(bits.reshape(-1, 8))
+        num_samples = (coeff * (n_repeat - 1) + 1) * K
+        sampling_rate = self.converter.hps.data.sampling_rate
+        executor = self._pool()
+        sources = iter(sources)
+        exhausted = False
+        pending = set()
+        batch = []
+
+        def progress(done):
+            elapsed = time.perf_counter() - start
+            return {'stats': dict(stats, done=done, seconds=elapsed,
+                                  files_per_second=stats['files'] / elapsed if elapsed else 0.)}
+
+        try:
+            while True:
+                while not exhausted and len(pending) < self.processes * 4:
+                    try:
+                        name, source = next(sources)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    pending.add(executor.submit(decode_source, name, source, sampling_rate, num_samples))
+                if not pending and not batch:
+                    break
+
+                if pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        name, audio, error = future.result()
+                        if error is not None:
+                            stats['files'] += 1
+                            stats['errors'] += 1
+                            yield {'file': name, 'error': error}
+                        else:
+                            batch.append((name, audio))
+
+                if len(batch) >= self.batch_size or (batch and not pending):
+                    decoded = self.converter.detect_watermarks([audio for _, audio in batch], n_repeat,
+                                                               batch_size=self.batch_size * n_repeat)
+                    for (name, _), found in zip(batch, decoded):
+                        stats['files'] += 1
+                        if found == 'Fail':
+                            stats['errors'] += 1
+                            yield {'file': name, 'error': 'Audio too short to hold a watermark'}
+                            continue
+                        watermarked = found == expected
+                        stats['watermarked' if watermarked else 'unmarked'] += 1
+                        yield {'file': name, 'watermarked': watermarked, 'message': found.rstrip('\x00')}
+                    batch = []
+
+                if time.perf_counter() - last_progress >= self.progress_interval:
+                    last_progress = time.perf_counter()
+                    yield progress(False)
+        finally:
+            # Stopped early (client gone): drop the decodes that have not started
+            for future in pending:
+                future.cancel()
+        yield progress(True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Verify the watermark of many audio files")
+    parser.add_argument('paths', nargs='+', help='Audio files, directories or .zip/.tar archives')
+    parser.add_argument('--message', type=str, default='@MyShell', help='Expected watermark message')
+    parser.add_argument('--processes', type=int, default=None, help='Decoding processes. Defaults to cpu_count')
+    parser.add_argument('--batch-size', type=int, default=64, help='Files per watermark decoding batch')
+    parser.add_argument('--config', type=str, default='checkpoints_v2/converter/config.json',
+                        help='Converter config, for its sampling rate')
+    parser.add_argument('--device', type=str, default='cpu', help='Device of the watermark model')
+    args = parser.parse_args()
+
+    from openvoice.api import ToneColorConverter
+
+    converter = ToneColorConverter(args.config, device=args.device)
+    auditor = WatermarkAuditor(converter, processes=args.processes, batch_size=args.batch_size)
+    for result in auditor.run(iter_sources(args.paths), message=args.message):
+        if 'stats' in result:
+            print(json.dumps(result), file=sys.stderr, flush=True)
+        if 'stats' not in result or result['stats']['done']:
+            print(json.dumps(result), flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,5 +2,6 @@
 # Activate conda environment
 source activate openvoice
 
-# Start the server
-uvicorn openvoice_server:app --host "0.0.0.0" --port 8000
+# Start the server. Set OPENVOICE_WORKERS > 1 on CPU hosts to serve from several
+# processes that share one copy of the model weights.
+python -m openvoice.main --host "0.0.0.0" --port 8000
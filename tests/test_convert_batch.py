@@ -0,0 +1,43 @@
+import json
+
+import numpy as np
+import torch
+
+from openvoice.api import OpenVoiceBaseClass, ToneColorConverter
+
+# The layout of checkpoints_v2/converter/config.json, with a smaller model
+CONFIG = {
+    "_version_": "v2",
+    "data": {"sampling_rate": 22050, "filter_length": 1024, "hop_length": 256, "win_length": 1024, "n_speakers": 0},
+    "model": {"zero_g": True, "inter_channels": 32, "hidden_channels": 32, "filter_channels": 64, "n_heads": 2,
+              "n_layers": 2, "kernel_size": 3, "p_dropout": 0.1, "resblock": "1",
+              "resblock_kernel_sizes": [3, 7, 11], "resblock_dilation_sizes": [[1, 3, 5], [1, 3, 5], [1, 3, 5]],
+              "upsample_rates": [8, 8, 2, 2], "upsample_initial_channel": 64, "upsample_kernel_sizes": [16, 16, 4, 4],
+              "gin_channels": 256},
+}
+
+
+def make_converter(tmp_path):
+    config_path = tmp_path / 'config.json'
+    config_path.write_text(json.dumps(CONFIG))
+    torch.manual_seed(0)
+    # Random weights will do, and conversion doesn't need the watermark model
+    converter = ToneColorConverter.__new__(ToneColorConverter)
+    OpenVoiceBaseClass.__init__(converter, str(config_path), device='cpu')
+    return converter
+
+
+def test_batched_conversion_matches_one_at_a_time(tmp_path):
+    converter = make_converter(tmp_path)
+    rng = np.random.default_rng(0)
+    a = converter.spectrogram(rng.uniform(-0.5, 0.5, 22050).astype(np.float32))
+    b = converter.spectrogram(rng.uniform(-0.5, 0.5, 9000).astype(np.float32))
+    c = converter.spectrogram(rng.uniform(-0.5, 0.5, 9000).astype(np.float32))
+    src_se, tgt_se = torch.randn(1, 256, 1), torch.randn(1, 256, 1)
+
+    # tau=0 makes the posterior deterministic, so only batching can make a difference
+    batched = converter.convert_batch([a, b, c], [src_se] * 3, [tgt_se] * 3, tau=0.)
+    for spec, audio in zip([a, b, c], batched):
+        alone, = converter.convert_batch([spec], [src_se], [tgt_se], tau=0.)
+        assert audio.shape == alone.shape
+        np.testing.assert_allclose(audio, alone, atol=1e-5)
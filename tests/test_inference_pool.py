@@ -0,0 +1,69 @@
+import asyncio
+import threading
+
+from openvoice.inference_pool import InferencePool
+
+
+def test_cancelled_queued_run_releases_its_slot():
+    pool = InferencePool(max_workers=1, max_queue=2)
+    started = threading.Event()
+    release = threading.Event()
+
+    def block():
+        started.set()
+        release.wait()
+        return 'done'
+
+    async def scenario():
+        running = asyncio.ensure_future(pool.run(block))
+        await asyncio.to_thread(started.wait)
+        queued = asyncio.ensure_future(pool.run(lambda: 'never'))
+        await asyncio.sleep(0)
+        assert (pool.running, pool.queued) == (1, 1)
+        # What stream_sentences does to the next sentence when the client goes away
+        queued.cancel()
+        await asyncio.sleep(0)
+        assert (pool.running, pool.queued) == (1, 0)
+        release.set()
+        return await running
+
+    try:
+        assert asyncio.run(scenario()) == 'done'
+    finally:
+        release.set()
+        pool.shutdown()
+    assert (pool.running, pool.queued) == (0, 0)
+
+
+def test_cancelled_jobs_do_not_fill_the_queue():
+    pool = InferencePool(max_workers=1, max_queue=2)
+    release = threading.Event()
+    try:
+        blocker = pool.submit(release.wait)
+        for _ in range(10):
+            assert pool.submit(lambda: None).cancel()
+        assert pool.queued == 0
+        release.set()
+        blocker.result()
+    finally:
+        release.set()
+        pool.shutdown()
+
+
+def test_submit_when_room_waits_for_a_slot():
+    pool = InferencePool(max_workers=1, max_queue=0)
+    release = threading.Event()
+    submitted = threading.Event()
+    try:
+        blocker = pool.submit(release.wait)
+        waiter = threading.Thread(target=lambda: (pool.submit_when_room(lambda: None).result(), submitted.set()))
+        waiter.start()
+        assert not submitted.wait(0.2)
+        release.set()
+        assert submitted.wait(5)
+        waiter.join()
+        blocker.result()
+    finally:
+        release.set()
+        pool.shutdown()
+    assert (pool.running, pool.queued) == (0, 0)